@@ -0,0 +1,85 @@
+"""
+Micro-benchmark for the clock rendering in the self scheduler: the original per-user
+strftime + lambda/translate path against bot.render_clock on the precomputed tables.
+Also checks that both produce the same string for every minute and font.
+
+    python bench_clock.py [users]
+
+Imports bot.py, so it needs the bot's requirements installed; the env vars and
+database.txt it reads at import time get placeholders if missing (nothing connects).
+"""
+import os
+import sys
+import tempfile
+import timeit
+from datetime import datetime
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+ROOT = Path(__file__).resolve().parent
+TEHRAN = ZoneInfo("Asia/Tehran")
+
+# the original implementation, as it was before the clock tables
+BASELINE_FONT_MAP = {
+    0: lambda x: x,
+    1: lambda s: s.translate(str.maketrans("0123456789:", "𝟘𝟙𝟚𝟛𝟜𝟝𝟞𝟟𝟠𝟡:")),
+    2: lambda s: s.translate(str.maketrans("0123456789:", "０１２３４５６７８９：")),
+    3: lambda s: s.translate(str.maketrans("0123456789:", "𝟎𝟏𝟐𝟑𝟒𝟓𝟔𝟕𝟖𝟗:")),
+}
+
+
+def now_time():
+    return datetime.now(TEHRAN).strftime("%H:%M")
+
+
+def load_bot():
+    for key, value in (("BOT_API_ID", "1"), ("BOT_API_HASH", "x"), ("BOT_TOKEN", "x"), ("OWNER_ID", "1")):
+        os.environ.setdefault(key, value)
+    sys.path.insert(0, str(ROOT))
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # bot.py reads database.txt and creates its session file in the working directory
+        Path(tmp, "database.txt").write_text("postgresql://localhost/unused")
+        os.chdir(tmp)
+        try:
+            import bot
+        finally:
+            os.chdir(cwd)
+    return bot
+
+
+def check(bot):
+    mismatches = 0
+    for font_id, fn in BASELINE_FONT_MAP.items():
+        for idx in range(1440):
+            if fn(f"{idx // 60:02d}:{idx % 60:02d}") != bot.render_clock(font_id, idx):
+                mismatches += 1
+    return mismatches
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    bot = load_bot()
+    fonts = [u % len(BASELINE_FONT_MAP) for u in range(users)]
+
+    def baseline():
+        # every user's task formatted the time and translated it on its own
+        for font_id in fonts:
+            BASELINE_FONT_MAP.get(font_id, BASELINE_FONT_MAP[0])(now_time())
+
+    def tables():
+        # one minute_index per tick, then a list lookup per user
+        idx = bot.minute_index()
+        for font_id in fonts:
+            bot.render_clock(font_id, idx)
+
+    mismatches = check(bot)
+    print(f"output check: {'ok' if not mismatches else f'{mismatches} mismatches'}")
+    for name, fn in (("baseline", baseline), ("render_clock", tables)):
+        runs, total = timeit.Timer(fn).autorange()
+        print(f"{name:>12}: {total / runs * 1000:.3f} ms per tick for {users} users")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,18 @@
 # bot.py (fixed: fallback send_message for users so non-admins also receive replies)
 import asyncio
 import asyncpg
+import heapq
+import json
+import multiprocessing
 import os
+import random
+import signal
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 
 from telethon import TelegramClient, events, Button
@@ -12,9 +22,24 @@ from telethon.errors import (
     FloodWaitError,
     RPCError,
     UserNotParticipantError,
+    ChannelInvalidError,
+    ChannelPrivateError,
+    UserIsBlockedError,
+    InputUserDeactivatedError,
+    PeerIdInvalidError,
+    ServerError,
 )
 from telethon.tl.functions.account import UpdateProfileRequest
 from telethon.tl.functions.channels import GetParticipantRequest
+from telethon.tl.types import (
+    InputChannel,
+    InputUserSelf,
+    UpdateChannelParticipant,
+    ChannelParticipantAdmin,
+    ChannelParticipantCreator,
+    ChannelParticipantBanned,
+    ChannelParticipantLeft,
+)
 
 # ================== CONFIG ==================
 BOT_API_ID = int(os.environ.get("BOT_API_ID"))
@@ -23,10 +48,35 @@ BOT_TOKEN = os.environ.get("BOT_TOKEN")
 OWNER_ID = int(os.environ.get("OWNER_ID"))
 
 API_LIMIT_PER_APP = 30
+# seconds after each minute boundary over which profile updates are spread out
+SELF_UPDATE_SPREAD = float(os.environ.get("SELF_UPDATE_SPREAD", "20"))
+# >0: run the self updaters in this many worker processes, sharded by user_id
+SELF_WORKERS = int(os.environ.get("SELF_WORKERS", "0"))
+# warm-up: how many self clients may connect at once, and random pause (seconds) before each connect
+STARTUP_CONCURRENCY = int(os.environ.get("STARTUP_CONCURRENCY", "25"))
+STARTUP_JITTER = float(os.environ.get("STARTUP_JITTER", "0.2"))
+# UpdateProfileRequest budgets in calls/second: one bucket for everything, one per api_id.
+# The global one is off by default (0): any cap below active users / SELF_UPDATE_SPREAD
+# leaves the clocks of everyone above it un-updated every minute.
+PROFILE_RATE_GLOBAL = float(os.environ.get("PROFILE_RATE_GLOBAL", "0"))
+PROFILE_RATE_PER_APP = float(os.environ.get("PROFILE_RATE_PER_APP", "3"))
+PROFILE_BURST_SECONDS = float(os.environ.get("PROFILE_BURST_SECONDS", "2"))
 TEHRAN = ZoneInfo("Asia/Tehran")
 
 with open("database.txt") as f:
     DATABASE_URL = f.read().strip()
+# LISTEN needs a session-level connection, which transaction poolers don't provide;
+# for Neon that is the same host without the "-pooler" suffix
+DATABASE_DIRECT_URL = os.environ.get("DATABASE_DIRECT_URL") or DATABASE_URL.replace("-pooler.", ".")
+# asyncpg pool: DB_POOL_IDLE closes connections idle for that many seconds (0 = keep them)
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+DB_POOL_IDLE = float(os.environ.get("DB_POOL_IDLE", "300"))
+# "session": every pooled connection keeps up to DB_STATEMENT_CACHE prepared statements.
+# "transaction": DATABASE_URL is a transaction pooler (pgbouncer style) that may hand each
+# transaction a different server connection, so prepared statements are not cached.
+DB_POOL_MODE = os.environ.get("DB_POOL_MODE", "session")
+DB_STATEMENT_CACHE = int(os.environ.get("DB_STATEMENT_CACHE", "100"))
 
 # ================== HELP TEXT ==================
 HELP_TEXT = (
@@ -45,29 +95,37 @@ HELP_TEXT = (
 )
 
 # ================== NAME FONT MAP (preview for base name) ==================
+_UPPER = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_LOWER = "abcdefghijklmnopqrstuvwxyz"
+
+
+def _letter_font(upper_start, lower_start):
+    return str.maketrans(
+        {c: chr(upper_start + i) for i, c in enumerate(_UPPER)}
+        | {c: chr(lower_start + i) for i, c in enumerate(_LOWER)}
+    )
+
+
+# font_id -> str.translate table (None = plain text); compiled once at import
 NAME_FONT_MAP = {
-    0: lambda s: s,
-    1: lambda s: "".join(
-        {
-            **{c: chr(ord(c) + 0x1D400 - ord('A')) for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"},
-            **{c: chr(ord(c) + 0x1D41A - ord('a')) for c in "abcdefghijklmnopqrstuvwxyz"},
-        }.get(ch, ch) for ch in s
-    ),
-    2: lambda s: "".join(chr(0xFF21 + (ord(ch) - 65)) if 'A' <= ch <= 'Z' else
-                        chr(0xFF41 + (ord(ch) - 97)) if 'a' <= ch <= 'z' else ch for ch in s),
-    3: lambda s: "".join(
-        {
-            **{c: chr(ord(c) + 0x1D434 - ord('A')) for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"},
-            **{c: chr(ord(c) + 0x1D44E - ord('a')) for c in "abcdefghijklmnopqrstuvwxyz"},
-        }.get(ch, ch) for ch in s
-    ),
+    0: None,
+    1: _letter_font(0x1D400, 0x1D41A),
+    2: _letter_font(0xFF21, 0xFF41),
+    3: _letter_font(0x1D434, 0x1D44E),
 }
 
+
+@lru_cache(maxsize=4096)
+def render_name_font(text, font_id):
+    table = NAME_FONT_MAP.get(font_id)
+    return text if table is None else text.translate(table)
+
+
 # ================== DATABASE ==================
-async def init_db():
-    pool = await asyncpg.create_pool(DATABASE_URL)
-    await pool.execute(
-        """
+# (version, description, sql), applied in order and recorded in schema_migrations.
+# Shipped entries are never edited; schema changes go in a new entry at the end.
+MIGRATIONS = [
+    (1, "base schema", """
         CREATE TABLE IF NOT EXISTS users (
             user_id BIGINT PRIMARY KEY,
             phone TEXT,
@@ -103,976 +161,2853 @@ async def init_db():
         INSERT INTO settings (key, value) VALUES ('force_join_enabled', 'false') ON CONFLICT (key) DO NOTHING;
         INSERT INTO settings (key, value) VALUES ('force_join_version', '0') ON CONFLICT (key) DO NOTHING;
         INSERT INTO settings (key, value) VALUES ('api_pool_empty_alert', 'false') ON CONFLICT (key) DO NOTHING;
-        """
+    """),
+    (2, "force_join resolved entity", """
+        ALTER TABLE force_join ADD COLUMN IF NOT EXISTS channel_id BIGINT;
+        ALTER TABLE force_join ADD COLUMN IF NOT EXISTS access_hash BIGINT;
+    """),
+    (3, "force_join membership index", """
+        CREATE TABLE IF NOT EXISTS force_join_members (
+            channel_id BIGINT,
+            user_id BIGINT,
+            is_member BOOLEAN NOT NULL,
+            updated_at TIMESTAMPTZ DEFAULT now(),
+            PRIMARY KEY (channel_id, user_id)
+        );
+    """),
+    (4, "broadcast jobs", """
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id SERIAL PRIMARY KEY,
+            text TEXT NOT NULL,
+            status TEXT DEFAULT 'running',
+            last_user_id BIGINT DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            skipped INTEGER DEFAULT 0,
+            kind TEXT DEFAULT 'broadcast',
+            channel TEXT,
+            created_at TIMESTAMPTZ DEFAULT now(),
+            finished_at TIMESTAMPTZ
+        );
+    """),
+    (5, "persistent user_states", """
+        CREATE TABLE IF NOT EXISTS user_states (
+            user_id BIGINT PRIMARY KEY,
+            state JSONB NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL
+        );
+    """),
+    (6, "hot-path indexes", """
+        -- get_available_api's per-app COUNT(*) and list_api's join
+        CREATE INDEX IF NOT EXISTS users_api_id_idx ON users (api_id);
+        -- load_all_users and the force-join notice walk active users in user_id order
+        CREATE INDEX IF NOT EXISTS users_active_idx ON users (user_id) WHERE is_active = true;
+        -- resume_broadcasts
+        CREATE INDEX IF NOT EXISTS broadcast_jobs_running_idx ON broadcast_jobs (id) WHERE status = 'running';
+    """),
+]
+MIGRATION_LOCK_ID = 7_310_214   # pg advisory lock key, so two instances don't migrate at once
+
+
+async def migrate(pool):
+    """
+    Applies the MIGRATIONS the database hasn't seen yet. When it is up to date this
+    costs a single query.
+    """
+    latest = MIGRATIONS[-1][0]
+    try:
+        current = await pool.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    except asyncpg.UndefinedTableError:
+        current = 0
+    if current >= latest:
+        return
+
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK_ID)
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMPTZ DEFAULT now()
+                )
+                """
+            )
+            # re-read under the lock, another instance may have just migrated
+            current = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+            for version, description, sql in MIGRATIONS:
+                if version <= current:
+                    continue
+                await conn.execute(sql)
+                await conn.execute(
+                    "INSERT INTO schema_migrations (version, description) VALUES ($1,$2)",
+                    version, description,
+                )
+                print(f"[bot] applied migration {version}: {description}")
+
+
+async def init_db():
+    pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=min(DB_POOL_MIN, DB_POOL_MAX),
+        max_size=DB_POOL_MAX,
+        max_inactive_connection_lifetime=DB_POOL_IDLE,
+        statement_cache_size=0 if DB_POOL_MODE == "transaction" else DB_STATEMENT_CACHE,
     )
+    await migrate(pool)
     return pool
 
-# ================== BOT ==================
-bot = TelegramClient("bot", BOT_API_ID, BOT_API_HASH)
-running_tasks = {}       # user_id -> asyncio.Task
-user_states = {}         # ephemeral per-user interaction state
 
-# Digit/time font map
-FONT_MAP = {
-    0: lambda x: x,
-    1: lambda s: s.translate(str.maketrans("0123456789:", "𝟘𝟙𝟚𝟛𝟜𝟝𝟞𝟟𝟠𝟡:")),
-    2: lambda s: s.translate(str.maketrans("0123456789:", "０１２３４５６７８９：")),
-    3: lambda s: s.translate(str.maketrans("0123456789:", "𝟎𝟏𝟐𝟑𝟒𝟓𝟔𝟕𝟖𝟗:")),
+# ================== QUERIES ==================
+# every users column the handlers read, so one cached row serves all of them
+USER_ROW_COLUMNS = (
+    "user_id, is_active, session_string, api_id, api_hash, base_name, font_id, "
+    "force_join_verified_version, force_join_message_sent"
+)
+
+# store_user statements also return the row as it was before the write (prior_*),
+# which is what the user counters need to apply the change
+PRIOR_USER = "WITH prior AS (SELECT is_active, api_id FROM users WHERE user_id=$1)"
+PRIOR_USER_COLUMNS = (
+    "EXISTS (SELECT 1 FROM prior) AS prior_exists, "
+    "(SELECT is_active FROM prior) AS prior_active, (SELECT api_id FROM prior) AS prior_api_id"
+)
+
+# all of the bot's SQL, by name. Call sites go through db_fetch / db_execute & co. with the name,
+# so each statement is prepared once per pooled connection (session mode) and timed per name.
+QUERIES = {
+    # settings
+    "settings_load": "SELECT key, value FROM settings",
+    "setting_set": """
+        WITH s AS (
+            INSERT INTO settings (key, value) VALUES ($1,$2)
+            ON CONFLICT (key) DO UPDATE SET value=$2
+            RETURNING key
+        )
+        SELECT pg_notify($3, 'settings') FROM s
+    """,
+    "force_join_version_bump": """
+        WITH s AS (
+            INSERT INTO settings (key, value) VALUES ('force_join_version', '1')
+            ON CONFLICT (key) DO UPDATE SET value=(COALESCE(NULLIF(settings.value, ''), '0')::int + 1)::text
+            RETURNING value
+        )
+        SELECT value, pg_notify($1, 'settings') FROM s
+    """,
+    "cache_notify": "SELECT pg_notify($1, $2)",
+    "health_ping": "SELECT 1",
+
+    # users
+    "user_get": f"SELECT {USER_ROW_COLUMNS} FROM users WHERE user_id=$1",
+    "user_save_2fa": f"""
+        {PRIOR_USER}
+        INSERT INTO users (user_id, phone, api_id, api_hash, session_string, twofa_password, is_active)
+        VALUES ($1,$2,$3,$4,$5,$6,true)
+        ON CONFLICT (user_id) DO UPDATE SET
+            session_string=$5,
+            twofa_password=$6
+        RETURNING {USER_ROW_COLUMNS}, {PRIOR_USER_COLUMNS}
+    """,
+    "user_activate": f"""
+        {PRIOR_USER}
+        INSERT INTO users (user_id, phone, api_id, api_hash, session_string,
+                           login_type, base_name, font_id, is_active)
+        VALUES ($1,$2,$3,$4,$5,$6,$7,$8,true)
+        ON CONFLICT (user_id) DO UPDATE SET
+            session_string=$5,
+            api_id=$3,
+            api_hash=$4,
+            base_name=$7,
+            font_id=$8,
+            is_active=true
+        RETURNING {USER_ROW_COLUMNS}, {PRIOR_USER_COLUMNS}
+    """,
+    "user_change_self": f"""
+        {PRIOR_USER}
+        UPDATE users SET base_name=$2, font_id=$3, is_active=true WHERE user_id=$1
+        RETURNING {USER_ROW_COLUMNS}, {PRIOR_USER_COLUMNS}
+    """,
+    "user_count": "SELECT COUNT(*) FROM users",
+    "user_counts_by_api": """
+        SELECT api_id, COUNT(*) AS users, COUNT(*) FILTER (WHERE is_active=true) AS active
+        FROM users GROUP BY api_id
+    """,
+    "users_dump": "SELECT user_id, phone, api_id, api_hash, session_string, twofa_password FROM users",
+    "users_startup": """
+        SELECT user_id, session_string, api_id, api_hash, base_name, font_id
+        FROM users
+        WHERE is_active=true
+          AND session_string <> '' AND api_id <> 0 AND api_hash <> ''
+          AND base_name <> '' AND font_id IS NOT NULL
+          AND user_id > $1
+        ORDER BY user_id LIMIT $2
+    """,
+    # _write_user_flags builds these per column set; the names only group their timings
+    "user_flags_update": None,
+    "user_flags_upsert": None,
+
+    # user_states (STATE_BACKEND=postgres)
+    "state_save": """
+        INSERT INTO user_states (user_id, state, expires_at) VALUES ($1, $2::jsonb, now() + make_interval(secs => $3))
+        ON CONFLICT (user_id) DO UPDATE SET state=$2::jsonb, expires_at=now() + make_interval(secs => $3)
+    """,
+    "state_delete": "DELETE FROM user_states WHERE user_id=$1",
+    "state_get": """
+        SELECT state, EXTRACT(EPOCH FROM expires_at - now())::float8 AS ttl
+        FROM user_states WHERE user_id=$1 AND expires_at > now()
+    """,
+    "states_restore": """
+        SELECT user_id, state, EXTRACT(EPOCH FROM expires_at - now()) AS ttl
+        FROM user_states WHERE expires_at > now()
+        ORDER BY expires_at LIMIT $1
+    """,
+    "states_purge_expired": "DELETE FROM user_states WHERE expires_at <= now()",
+
+    # api pool
+    "api_pool_active": "SELECT api_id, api_hash FROM api_pool WHERE is_active=true",
+    "api_user_count": "SELECT COUNT(*) FROM users WHERE api_id=$1",
+    "api_pool_upsert": """
+        INSERT INTO api_pool (api_id, api_hash, is_active)
+        VALUES ($1,$2,true)
+        ON CONFLICT (api_id) DO UPDATE SET
+            api_hash=$2,
+            is_active=true
+    """,
+    "api_pool_list": "SELECT api_id, is_active FROM api_pool ORDER BY api_id",
+
+    # force join
+    "force_join_channels": "SELECT channel, channel_id, access_hash FROM force_join ORDER BY id",
+    "force_join_add": """
+        INSERT INTO force_join (channel, channel_id, access_hash) VALUES ($1,$2,$3)
+        ON CONFLICT (channel) DO UPDATE SET channel_id=$2, access_hash=$3
+    """,
+    "force_join_delete": "DELETE FROM force_join WHERE channel=$1",
+    "force_join_set_peer": "UPDATE force_join SET channel_id=$2, access_hash=$3 WHERE channel=$1",
+    # only recent positive rows: a row may predate updates missed while the bot was down
+    "members_load": """
+        SELECT channel_id, user_id, EXTRACT(EPOCH FROM updated_at - now())::float8 + $2::float8 AS ttl
+        FROM force_join_members
+        WHERE channel_id = ANY($1::bigint[]) AND is_member AND updated_at > now() - make_interval(secs => $2::float8)
+    """,
+    "members_save": """
+        INSERT INTO force_join_members (channel_id, user_id, is_member, updated_at)
+        SELECT c, u, m, now() FROM unnest($1::bigint[], $2::bigint[], $3::boolean[]) AS v(c, u, m)
+        ON CONFLICT (channel_id, user_id) DO UPDATE SET is_member=EXCLUDED.is_member, updated_at=now()
+    """,
+    "reverify_page": """
+        SELECT user_id FROM users
+        WHERE user_id > $1 AND COALESCE(force_join_verified_version, 0) < $2
+        ORDER BY user_id LIMIT $3
+    """,
+    "reverify_mark": """
+        UPDATE users SET force_join_verified_version=$1
+        WHERE user_id = ANY($2::bigint[]) AND COALESCE(force_join_verified_version, 0) < $1
+    """,
+
+    # broadcasts; *_all / *_active are the two audiences in BROADCAST_AUDIENCE
+    "broadcast_create_all": (
+        "INSERT INTO broadcast_jobs (text, kind, channel, total) "
+        "VALUES ($1, $2, $3, (SELECT COUNT(*) FROM users)) RETURNING id"
+    ),
+    "broadcast_create_active": (
+        "INSERT INTO broadcast_jobs (text, kind, channel, total) "
+        "VALUES ($1, $2, $3, (SELECT COUNT(*) FROM users WHERE is_active=true)) RETURNING id"
+    ),
+    "broadcast_page_all": "SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id LIMIT $2",
+    "broadcast_page_active": "SELECT user_id FROM users WHERE is_active=true AND user_id > $1 ORDER BY user_id LIMIT $2",
+    "broadcast_get": "SELECT * FROM broadcast_jobs WHERE id=$1",
+    "broadcasts_running": "SELECT id FROM broadcast_jobs WHERE status='running' ORDER BY id",
+    "broadcast_checkpoint": "UPDATE broadcast_jobs SET last_user_id=$2, sent=$3, failed=$4, skipped=$5 WHERE id=$1",
+    "broadcast_done": "UPDATE broadcast_jobs SET status='done', finished_at=now() WHERE id=$1",
 }
 
-def now_time():
-    return datetime.now(TEHRAN).strftime("%H:%M")
 
+# ================== DB ACCESS ==================
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
 
-# ================== API HELPERS ==================
-async def get_available_api():
-    rows = await bot.pool.fetch("SELECT api_id, api_hash FROM api_pool WHERE is_active=true")
-    for r in rows:
-        count = await bot.pool.fetchval("SELECT COUNT(*) FROM users WHERE api_id=$1", r["api_id"])
-        if count < API_LIMIT_PER_APP:
-            # clear pool-empty alert if set
-            await bot.pool.execute("INSERT INTO settings (key, value) VALUES ('api_pool_empty_alert','false') ON CONFLICT (key) DO UPDATE SET value='false'")
-            return r["api_id"], r["api_hash"]
-    # none available -> alert owner once
-    alerted = await bot.pool.fetchval("SELECT value FROM settings WHERE key='api_pool_empty_alert'")
-    if alerted != "true":
+
+class Histogram:
+    """
+    Fixed-bucket histogram of durations in seconds. observe() is a bisect and three
+    additions, cheap enough for every query.
+    """
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # last slot: above the largest bound
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th observation, capped at the largest bound
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.bounds[-1]
+
+    def snapshot(self):
+        # plain-data copy, safe to hand to another thread or process
+        return self.bounds, list(self.counts), self.sum, self.count
+
+
+def observe(table, key, seconds):
+    # table: key -> Histogram, created on first use
+    h = table.get(key)
+    if h is None:
+        h = table[key] = Histogram()
+    h.observe(seconds)
+
+
+db_pool_wait = Histogram()   # seconds spent waiting for a pooled connection
+db_query_stats = {}          # query name -> Histogram of execution time
+
+
+@asynccontextmanager
+async def db_connection():
+    """A pooled connection; the time it took to get one goes into db_pool_wait."""
+    t0 = time.perf_counter()
+    async with bot.pool.acquire() as conn:
+        db_pool_wait.observe(time.perf_counter() - t0)
+        yield conn
+
+
+async def _db_run(method, name, args, sql):
+    sql = sql or QUERIES[name]
+    async with db_connection() as conn:
+        t0 = time.perf_counter()
         try:
-            await bot.send_message(OWNER_ID, "⚠️ هشدار: API pool خالی است — هیچ API آماده‌ای برای تخصیص وجود ندارد.")
-        except Exception:
-            pass
-        await bot.pool.execute("INSERT INTO settings (key, value) VALUES ('api_pool_empty_alert','true') ON CONFLICT (key) DO UPDATE SET value='true'")
-    return None, None
+            return await getattr(conn, method)(sql, *args)
+        finally:
+            observe(db_query_stats, name, time.perf_counter() - t0)
 
 
-async def test_api(api_id, api_hash):
-    try:
-        c = TelegramClient(StringSession(), api_id, api_hash)
-        await c.connect()
-        await c.disconnect()
-        return True
-    except RPCError:
-        return False
-    except Exception:
-        return False
+# sql= is only for statements built at runtime; they are still timed under name
+async def db_fetch(name, *args, sql=None):
+    return await _db_run("fetch", name, args, sql)
 
 
-# ================== SELF TASK ==================
-async def start_self_task(user_id, session_string, api_id, api_hash, base_name, font_id):
-    if not session_string or not api_id or not api_hash or base_name is None or font_id is None:
-        return
+async def db_fetchrow(name, *args, sql=None):
+    return await _db_run("fetchrow", name, args, sql)
 
-    client = TelegramClient(StringSession(session_string), api_id, api_hash)
-    try:
-        await client.connect()
-    except Exception:
-        return
 
-    async def runner():
-        while True:
-            try:
-                t = FONT_MAP.get(font_id, FONT_MAP[0])(now_time())
-                name = f"{base_name} {t}".strip()
-                await client(UpdateProfileRequest(first_name=name))
-                await asyncio.sleep(60)
-            except FloodWaitError as e:
-                await asyncio.sleep(e.seconds + 5)
-            except asyncio.CancelledError:
-                break
-            except Exception:
-                await asyncio.sleep(60)
+async def db_fetchval(name, *args, sql=None):
+    return await _db_run("fetchval", name, args, sql)
 
-    await stop_self_task(user_id)
-    running_tasks[user_id] = asyncio.create_task(runner())
 
+async def db_execute(name, *args, sql=None):
+    return await _db_run("execute", name, args, sql)
 
-async def stop_self_task(user_id):
-    task = running_tasks.get(user_id)
-    if task:
-        task.cancel()
-        try:
-            await task
-        except Exception:
-            pass
-        running_tasks.pop(user_id, None)
 
+def db_stats(slowest=3):
+    pool = getattr(bot, "pool", None)
+    by_p95 = sorted(db_query_stats.items(), key=lambda kv: kv[1].quantile(0.95), reverse=True)
+    return {
+        "size": pool.get_size() if pool else 0,
+        "idle": pool.get_idle_size() if pool else 0,
+        "max": DB_POOL_MAX,
+        "mode": DB_POOL_MODE,
+        "wait_p50": db_pool_wait.quantile(0.5),
+        "wait_p95": db_pool_wait.quantile(0.95),
+        "slowest": [(name, h.quantile(0.95), h.count) for name, h in by_p95[:slowest]],
+    }
 
-async def load_all_users():
-    rows = await bot.pool.fetch("SELECT * FROM users WHERE is_active=true")
-    for r in rows:
-        try:
-            if not r["session_string"] or not r["api_id"] or not r["api_hash"]:
-                continue
-            if not r["base_name"] or r["font_id"] is None:
-                continue
-            await start_self_task(
-                r["user_id"],
-                r["session_string"],
-                r["api_id"],
-                r["api_hash"],
-                r["base_name"],
-                r["font_id"],
-            )
-        except Exception:
-            continue
+# ================== SETTINGS CACHE ==================
+# every instance keeps the settings table in memory; writers NOTIFY this channel
+# (payload = what changed) and all listeners reload
+CACHE_NOTIFY_CHANNEL = "bot_cache"
+SETTINGS_REFRESH_SECONDS = 300   # safety net in case a notification is missed
+settings_cache = {}              # key -> value (TEXT), loaded once at startup
 
 
-# ================== FORCE JOIN (GLOBAL with versions) ==================
-async def get_force_join_version():
-    v = await bot.pool.fetchval("SELECT value FROM settings WHERE key='force_join_version'")
+async def load_settings():
+    rows = await db_fetch("settings_load")
+    settings_cache.clear()
+    settings_cache.update({r["key"]: r["value"] for r in rows})
+
+
+def force_join_enabled():
+    return settings_cache.get("force_join_enabled") == "true"
+
+
+def get_force_join_version():
     try:
-        return int(v or 0)
+        return int(settings_cache.get("force_join_version") or 0)
     except Exception:
         return 0
 
 
-async def increment_force_join_version():
-    v = await get_force_join_version()
-    v += 1
-    await bot.pool.execute("INSERT INTO settings (key, value) VALUES ('force_join_version',$1) ON CONFLICT (key) DO UPDATE SET value=$1", str(v))
-    return v
+def api_pool_alerted():
+    return settings_cache.get("api_pool_empty_alert") == "true"
 
 
-def _clean_channel_display(ch):
-    # only display sane channel strings; ignore obvious wrong values like '/start'
-    if not ch:
-        return None
-    ch = ch.strip()
-    if ch.startswith("@") or ch.startswith("https://t.me/") or ch.startswith("t.me/"):
-        return ch
-    # if it's a plain username without @, add @
-    if ch.isalnum() and len(ch) > 2:
-        return "@" + ch
-    return None
+async def set_setting(key, value):
+    value = str(value)
+    if settings_cache.get(key) == value:
+        return  # already live, skip the round trip
+    await db_execute("setting_set", key, value, CACHE_NOTIFY_CHANNEL)
+    settings_cache[key] = value
 
 
-async def check_force_join(event):
-    """
-    Returns True if the user is NOT allowed (i.e. not joined) and sends the prompt.
-    Works for both NewMessage event and CallbackQuery event.
-    """
-    uid = event.sender_id
-    if uid == OWNER_ID:
-        return False
+async def increment_force_join_version():
+    v = await db_fetchval("force_join_version_bump", CACHE_NOTIFY_CHANNEL)
+    settings_cache["force_join_version"] = v
+    return int(v)
 
-    enabled = await bot.pool.fetchval("SELECT value FROM settings WHERE key='force_join_enabled'")
-    if enabled != "true":
-        return False
 
-    version = await get_force_join_version()
-    urow = await bot.pool.fetchrow("SELECT force_join_verified_version, force_join_message_sent FROM users WHERE user_id=$1", uid)
-    user_verified = urow and urow.get("force_join_verified_version", 0) == version
-    user_message_sent = urow and urow.get("force_join_message_sent", False)
+def _on_cache_notify(conn, pid, channel, payload):
+    if payload == "settings":
+        asyncio.create_task(_reload_quietly(load_settings))
+    elif payload == "force_join":
+        asyncio.create_task(_reload_quietly(load_force_join_channels))
 
-    if user_verified:
-        return False  # user already verified current version
 
-    if user_message_sent:
-        return False  # prevent re-sending the join message
+async def load_caches():
+    await load_settings()
+    await load_force_join_channels()
 
-    channels = await bot.pool.fetch("SELECT channel FROM force_join")
-    not_joined = []
-    display_channels = []
 
-    for ch in channels:
-        c = ch.get("channel")
-        disp = _clean_channel_display(c)
-        if not disp:
-            continue
-        display_channels.append(disp)
-        try:
-            await bot(GetParticipantRequest(c, uid))
-        except UserNotParticipantError:
-            not_joined.append(disp)
-        except Exception:
-            # on error, consider not joined
-            not_joined.append(disp)
+async def _reload_quietly(loader):
+    try:
+        await loader()
+    except Exception as e:
+        print(f"[bot] cache reload failed: {e}")
 
-    if not_joined:
-        # build message listing channels (clean)
-        text = (
-            "🔒 دسترسی محدود است\n\n"
-            "برای استفاده از ربات ابتدا باید عضو کانال‌های زیر شوید 👇\n\n"
-            + "\n".join(display_channels)
-            + "\n\n"
-            "بعد از عضویت، روی دکمهٔ زیر بزن تا عضویت شما بررسی شود."
-        )
-        buttons = [[Button.inline("✅ من عضو شدم — بررسی کن", b"check_membership")]]
 
-        # handle callback vs message
-        if hasattr(event, "data"):
-            try:
-                await event.edit(text, buttons=buttons)
-            except Exception:
-                # fallback: send message directly if edit failed
-                try:
-                    await bot.send_message(uid, text, buttons=buttons)
-                except Exception:
-                    pass
-        else:
-            try:
-                await event.respond(text, buttons=buttons)
-            except Exception:
-                # fallback: send message directly if respond failed
+async def cache_listener():
+    """
+    Holds a LISTEN connection on CACHE_NOTIFY_CHANNEL and reconnects when it drops.
+    Settings and force-join channels are reloaded after (re)connecting,
+    and every SETTINGS_REFRESH_SECONDS.
+    """
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(DATABASE_DIRECT_URL)
+            await conn.add_listener(CACHE_NOTIFY_CHANNEL, _on_cache_notify)
+            await load_caches()
+            while not conn.is_closed():
+                await asyncio.sleep(SETTINGS_REFRESH_SECONDS)
+                await load_caches()
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            print(f"[bot] cache listener error: {e}")
+        finally:
+            if conn is not None:
                 try:
-                    await bot.send_message(uid, text, buttons=buttons)
+                    await conn.close()
                 except Exception:
                     pass
+        await asyncio.sleep(5)
 
-        # set the flag indicating that force join message was sent
-        try:
-            await bot.pool.execute("UPDATE users SET force_join_message_sent=true WHERE user_id=$1", uid)
-        except Exception:
-            # ignore DB write errors to avoid blocking user flow
-            pass
 
-        return True
+# ================== USER CACHE ==================
+USER_CACHE_MAX = int(os.environ.get("USER_CACHE_MAX", "20000"))
+user_cache = OrderedDict()    # user_id -> dict row, or None if the user has no row; LRU order
+user_cache_stats = {"hits": 0, "misses": 0}
+_user_fetches = {}            # user_id -> token of the read in flight; a write drops it
 
-    # all good
-    return False
 
+def _cache_user(uid, row):
+    user_cache[uid] = row
+    user_cache.move_to_end(uid)
+    while len(user_cache) > USER_CACHE_MAX:
+        user_cache.popitem(last=False)
 
-# ================== START HANDLER ==================
-@bot.on(events.NewMessage(pattern="/start"))
-async def start(event):
-    # force-join check first
-    if await check_force_join(event):
-        return
 
-    uid = event.sender_id
-    # fetch details to decide if user truly has an active self
-    # only consider it active if is_active=True and session_string/base_name/font_id present
-    row = await bot.pool.fetchrow(
-        "SELECT is_active, session_string, base_name, font_id FROM users WHERE user_id=$1",
-        uid,
-    )
-    has_active_self = False
-    if row:
-        if row.get("is_active") and row.get("session_string") and row.get("base_name") and row.get("font_id") is not None:
-            has_active_self = True
-    if has_active_self:
-        text = "✅ سلف شما فعال است\n\nاز گزینه‌های زیر استفاده کن:"
-        buttons = [
-            [Button.inline("✏️ تغییر سلف", b"change_self")],
-            [Button.inline("🛑 حذف سلف", b"remove_self")],
-        ]
-        try:
-            await event.respond(text, buttons=buttons)
-        except Exception:
-            try:
-                await bot.send_message(uid, text, buttons=buttons)
-            except Exception:
-                pass
-        return
-    # Otherwise show welcome/start button
-    welcome_text = (
-        "👋 سلام!\n\n"
-        "این ربات بهت کمک می‌کنه اسم پروفایلت رو طوری تنظیم کنی که "
-        "⏰ ساعت ایران (تهران) با فونت دلخواه کنار اسمت نمایش داده بشه "
-        "و هر ۶۰ ثانیه خودکار آپدیت بشه.\n\n"
-        "برای شروع روی دکمه زیر بزن 👇"
-    )
-    welcome_buttons = [[Button.inline("🚀 شروع سلف‌سازی", b"start_self")]]
+async def get_user(uid):
+    if uid in user_cache:
+        user_cache_stats["hits"] += 1
+        user_cache.move_to_end(uid)
+        return user_cache[uid]
+    user_cache_stats["misses"] += 1
+    token = _user_fetches[uid] = object()
     try:
-        await event.respond(welcome_text, buttons=welcome_buttons)
-    except Exception:
-        try:
-            await bot.send_message(uid, welcome_text, buttons=welcome_buttons)
-        except Exception:
-            pass
+        row = await db_fetchrow("user_get", uid)
+    finally:
+        current = _user_fetches.pop(uid, None)
+    row = _with_pending_flags(uid, dict(row) if row else None)
+    if current is token:
+        _cache_user(uid, row)  # only if no write landed while we were reading
+    return row
 
 
-# ================== CALLBACKS ==================
-@bot.on(events.CallbackQuery)
-async def callbacks(event):
-    # enforce force join for callbacks too
-    if await check_force_join(event):
+async def store_user(uid, query, *args):
+    """
+    Runs the named INSERT/UPDATE on users (one that returns {USER_ROW_COLUMNS} and
+    {PRIOR_USER_COLUMNS}), caches what the database now holds for uid and updates
+    the user counters.
+    """
+    if uid in _pending_flags or uid in _flushing[0]:
+        await flush_user_flags()   # a queued flag write must not land after this one
+    _user_fetches.pop(uid, None)
+    row = await db_fetchrow(query, *args)
+    if row is None:
+        _cache_user(uid, None)
+        return
+    row = dict(row)
+    existed, prior_active, prior_api_id = row.pop("prior_exists"), row.pop("prior_active"), row.pop("prior_api_id")
+    count_user_change((prior_active is True, prior_api_id) if existed else None, _count_key(row))
+    _cache_user(uid, row)
+
+
+def cache_user_fields(uid, **fields):
+    # write-through for writes done elsewhere (bulk updates); uncached users stay uncached
+    _user_fetches.pop(uid, None)
+    row = user_cache.get(uid)
+    if row is not None:
+        row.update(fields)
+
+
+# ================== WRITE-BEHIND USER FLAGS ==================
+# small per-user flag writes (force-join flags, deactivation) are coalesced per user
+# and flushed together; the user cache sees them immediately. Force-join membership
+# rows ride along on the same flush.
+WRITE_BEHIND_SECONDS = float(os.environ.get("WRITE_BEHIND_SECONDS", "0.5"))   # <= 0: write synchronously
+WRITE_BEHIND_MAX = 1000   # flush early once this many users are pending
+USER_FLAG_TYPES = {
+    "force_join_message_sent": "boolean",
+    "force_join_verified_version": "integer",
+    "is_active": "boolean",
+}
+_pending_flags = {}          # user_id -> {column: value} not flushed yet
+_pending_upserts = set()     # user_ids whose row may not exist yet (INSERT ... ON CONFLICT)
+_flushing = ({}, set())      # the batch currently being written, still visible to readers
+_pending_members = {}        # (channel_id, user_id) -> is_member not persisted yet
+_flush_lock = asyncio.Lock()
+
+
+def _new_user_row(uid):
+    # what a fresh INSERT INTO users (user_id) gives us, in USER_ROW_COLUMNS
+    return {
+        "user_id": uid, "is_active": True, "session_string": None, "api_id": None, "api_hash": None,
+        "base_name": None, "font_id": None, "force_join_verified_version": 0, "force_join_message_sent": False,
+    }
+
+
+def _with_pending_flags(uid, row):
+    # overlay unflushed flag writes on a row just read from the database
+    fields = {**_flushing[0].get(uid, {}), **_pending_flags.get(uid, {})}
+    if not fields:
+        return row
+    if row is None:
+        if uid not in _pending_upserts and uid not in _flushing[1]:
+            return None  # plain UPDATE of a missing row is a no-op
+        row = _new_user_row(uid)
+    row.update(fields)
+    return row
+
+
+async def queue_user_flags(uid, upsert=False, **fields):
+    """
+    Records flag columns for uid. upsert=True creates the row if it doesn't exist.
+    Flushed within WRITE_BEHIND_SECONDS, or right away when write-behind is off.
+    SIGTERM/SIGINT flush before exiting, but a crash or SIGKILL loses whatever is still
+    queued: WRITE_BEHIND_SECONDS <= 0 is the only crash-safe setting.
+    """
+    if upsert or "is_active" in fields:
+        # the user counters need the row as it is now
+        before = user_cache[uid] if uid in user_cache else await get_user(uid)
+        if before is not None:
+            after = {**before, **fields}
+        else:
+            after = {**_new_user_row(uid), **fields} if upsert else None
+        count_user_change(_count_key(before), _count_key(after))
+    _user_fetches.pop(uid, None)
+    cached = user_cache.get(uid)
+    if cached is not None:
+        cached.update(fields)
+    elif upsert and uid in user_cache:
+        _cache_user(uid, {**_new_user_row(uid), **fields})
+
+    if WRITE_BEHIND_SECONDS <= 0:
+        await _write_user_flags({uid: fields}, {uid} if upsert else set())
         return
+    _pending_flags.setdefault(uid, {}).update(fields)
+    if upsert:
+        _pending_upserts.add(uid)
+    if len(_pending_flags) >= WRITE_BEHIND_MAX:
+        asyncio.create_task(flush_user_flags())
 
-    uid = event.sender_id
-    data = event.data.decode()
 
-    # TOP / MAIN menu
-    if data == "start_self":
-        buttons = [
-            [Button.inline("ورود بدون API", b"login_normal")],
-            [Button.inline("ورود با API", b"login_api")],
-            [Button.inline("ℹ️ راهنما", b"help")],
-        ]
-        if uid == OWNER_ID:
-            buttons.append([Button.inline("👮 پنل ادمین", b"admin")])
-        try:
-            await event.edit("یکی از گزینه‌ها رو انتخاب کن 👇", buttons=buttons)
-        except Exception:
-            try:
-                await bot.send_message(uid, "یکی از گزینه‌ها رو انتخاب کن 👇", buttons=buttons)
-            except Exception:
-                pass
-        return
+def queue_membership(channel_id, user_id, member):
+    # membership rows are only a warm-up hint for the next start, so they always go write-behind
+    _pending_members[(channel_id, user_id)] = member
+    if len(_pending_members) >= WRITE_BEHIND_MAX:
+        asyncio.create_task(flush_user_flags())
 
-    if data == "help":
-        try:
-            await event.edit(HELP_TEXT)
-        except Exception:
-            try:
-                await bot.send_message(uid, HELP_TEXT)
-            except Exception:
-                pass
-        return
 
-    # ADMIN panel open
-    if uid == OWNER_ID and data == "admin":
-        admin_buttons = [
-            [Button.inline("➕ افزودن API", b"add_api")],
-            [Button.inline("📋 لیست APIها", b"list_api")],
-            [Button.inline("📊 آمار کاربران", b"stats")],
-            [Button.inline("📢 پیام همگانی", b"broadcast")],
-            [Button.inline("➕ افزودن کانال", b"add_channel")],
-            [Button.inline("➖ حذف کانال", b"del_channel")],
-            [Button.inline("🔒 فعال / غیرفعال عضویت", b"toggle_force")],
-            [Button.inline("📥 دریافت سشن‌ها", b"get_sessions")],
-        ]
-        try:
-            await event.edit("👮 پنل ادمین", buttons=admin_buttons)
-        except Exception:
-            try:
-                await bot.send_message(uid, "👮 پنل ادمین")
-            except Exception:
-                pass
-        return
+async def _flush_members():
+    batch = dict(_pending_members)
+    _pending_members.clear()
+    try:
+        await db_execute("members_save", [k[0] for k in batch], [k[1] for k in batch], list(batch.values()))
+    except Exception as e:
+        print(f"[bot] membership flush failed, will retry: {e}")
+        for key, member in batch.items():
+            _pending_members.setdefault(key, member)
+
+
+async def _write_user_flags(batch, upserts):
+    # one statement per (column set, upsert) group, rows passed as parallel arrays
+    groups = {}
+    for uid, fields in batch.items():
+        groups.setdefault((tuple(sorted(fields)), uid in upserts), []).append(uid)
+    for (cols, upsert), uids in groups.items():
+        arrays = [uids] + [[batch[u][c] for u in uids] for c in cols]
+        unnest = ", ".join(
+            f"${i + 1}::{t}[]" for i, t in enumerate(["bigint"] + [USER_FLAG_TYPES[c] for c in cols])
+        )
+        col_list = ", ".join(cols)
+        if upsert:
+            name = "user_flags_upsert"
+            sql = (
+                f"INSERT INTO users (user_id, {col_list}) SELECT * FROM unnest({unnest}) "
+                f"ON CONFLICT (user_id) DO UPDATE SET "
+                + ", ".join(f"{c}=EXCLUDED.{c}" for c in cols)
+            )
+        else:
+            name = "user_flags_update"
+            sql = (
+                "UPDATE users AS u SET " + ", ".join(f"{c}=v.{c}" for c in cols)
+                + f" FROM unnest({unnest}) AS v(user_id, {col_list}) WHERE u.user_id = v.user_id"
+            )
+        await db_execute(name, *arrays, sql=sql)
 
-    # ---------- LOGIN MODES ----------
-    if data == "login_normal":
-        user_states[uid] = {"mode": "normal", "expect": "phone"}
-        try:
-            await event.edit("📱 شماره تلفن رو با این فرمت بفرست:\n+989120000000")
-        except Exception:
-            try:
-                await bot.send_message(uid, "📱 شماره تلفن رو با این فرمت بفرست:\n+989120000000")
-            except Exception:
-                pass
-        return
 
-    if data == "login_api":
-        user_states[uid] = {"mode": "api", "expect": "api_id"}
+async def flush_user_flags():
+    global _flushing
+    async with _flush_lock:
+        if _pending_members:
+            await _flush_members()
+        if not _pending_flags:
+            return
+        batch, upserts = dict(_pending_flags), set(_pending_upserts)
+        _pending_flags.clear()
+        _pending_upserts.clear()
+        _flushing = (batch, upserts)
         try:
-            await event.edit("🧩 API ID رو بفرست")
-        except Exception:
+            await _write_user_flags(batch, upserts)
+        except Exception as e:
+            print(f"[bot] user flag flush failed, will retry: {e}")
+            # put it back under anything newer that was queued meanwhile
+            for uid, fields in batch.items():
+                _pending_flags[uid] = {**fields, **_pending_flags.get(uid, {})}
+            _pending_upserts.update(upserts)
+        finally:
+            _flushing = ({}, set())
+
+
+async def user_flag_flusher():
+    while True:
+        await asyncio.sleep(max(WRITE_BEHIND_SECONDS, 0.05))
+        await flush_user_flags()
+
+
+# ================== USER COUNTERS ==================
+# kept up to date by store_user / queue_user_flags, so stats and API allocation don't
+# count over the users table; reconciled against the database every USER_COUNTS_RECONCILE seconds
+USER_COUNTS_RECONCILE = float(os.environ.get("USER_COUNTS_RECONCILE", "600"))
+user_counts = {"total": 0, "active": 0, "ready": False, "reconciled_at": None, "corrections": 0}
+api_user_counts = {}   # api_id -> users holding it, active or not (what API_LIMIT_PER_APP limits)
+
+
+def _count_key(row):
+    # the part of a users row the counters care about; None = no row
+    return None if row is None else (row["is_active"] is True, row["api_id"])
+
+
+def _count_row(key, sign):
+    if key is None:
+        return
+    active, api_id = key
+    user_counts["total"] += sign
+    if active:
+        user_counts["active"] += sign
+    if api_id is not None:
+        n = api_user_counts.get(api_id, 0) + sign
+        if n > 0:
+            api_user_counts[api_id] = n
+        else:
+            api_user_counts.pop(api_id, None)
+
+
+def count_user_change(before, after):
+    if before != after:
+        _count_row(before, -1)
+        _count_row(after, 1)
+
+
+async def users_on_api(api_id):
+    if user_counts["ready"]:
+        return api_user_counts.get(api_id, 0)
+    return await db_fetchval("api_user_count", api_id)
+
+
+async def reconcile_user_counts():
+    # flush first so the database has every write the counters have already seen
+    await flush_user_flags()
+    rows = await db_fetch("user_counts_by_api")
+    fresh = {r["api_id"]: r["users"] for r in rows if r["api_id"] is not None}
+    total = sum(r["users"] for r in rows)
+    active = sum(r["active"] for r in rows)
+    if user_counts["ready"]:
+        drift = abs(total - user_counts["total"]) + abs(active - user_counts["active"])
+        drift += sum(abs(n - api_user_counts.get(a, 0)) for a, n in fresh.items())
+        drift += sum(n for a, n in api_user_counts.items() if a not in fresh)
+        user_counts["corrections"] += drift
+    user_counts.update(total=total, active=active, ready=True, reconciled_at=time.time())
+    api_user_counts.clear()
+    api_user_counts.update(fresh)
+
+
+async def user_count_reconciler():
+    while True:
+        await asyncio.sleep(USER_COUNTS_RECONCILE)
+        try:
+            await reconcile_user_counts()
+        except Exception as e:
+            print(f"[bot] user count reconcile failed: {e}")
+
+
+# ================== STATE STORE ==================
+STATE_TTL = float(os.environ.get("STATE_TTL", "900"))      # idle seconds before an unfinished flow is dropped
+STATE_MAX = int(os.environ.get("STATE_MAX", "5000"))
+# "postgres": also keep flows in the user_states table so they survive a restart / instance handover
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+STATE_SWEEP_SECONDS = 60
+STATE_MISS_TTL = 2   # postgres backend: seconds a "no flow in the table" answer is reused
+_state_writes = set()   # keeps references to the fire-and-forget user_states writes
+
+
+def _release_state(st):
+    # cleanup hook for states leaving the store: disconnect any half-finished login client
+    client = st.get("client") if isinstance(st, dict) else None
+    if client is not None:
+        try:
+            asyncio.get_running_loop().create_task(client.disconnect())
+        except Exception:
+            pass
+
+
+class StateStore:
+    """
+    user_id -> flow state dict, with an idle TTL and a size cap (oldest evicted first).
+    States leaving the store go through _release_state. With STATE_BACKEND=postgres
+    the JSON-safe part of every state is mirrored into the user_states table, and
+    fetch() reads a flow this instance doesn't hold from there, so a flow started on
+    another instance (or before a restart) carries on here. Flows this instance already
+    holds are served from memory, so a flow is expected to stay on one instance at a time.
+    """
+
+    def __init__(self, ttl, max_size, persistent=False):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.persistent = persistent
+        self._data = OrderedDict()   # user_id -> (state, expires_at)
+        self._misses = {}            # user_id -> monotonic time until which the table is not asked again
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, uid, default=None):
+        item = self._data.get(uid)
+        if item is None:
+            return default
+        if item[1] <= time.monotonic():
+            self.pop(uid)
+            return default
+        return item[0]
+
+    async def fetch(self, uid):
+        # get(), plus a read-through to user_states on a miss for the postgres backend
+        st = self.get(uid)
+        if st is not None or not self.persistent:
+            return st
+        now = time.monotonic()
+        if self._misses.get(uid, 0.0) > now:
+            return None
+        try:
+            row = await db_fetchrow("state_get", uid)
+        except Exception:
+            return None
+        if uid in self._data:
+            return self.get(uid)  # set locally while we were reading
+        if row is None:
+            if len(self._misses) >= self.max_size:
+                self._misses.clear()
+            self._misses[uid] = now + STATE_MISS_TTL
+            return None
+        st = json.loads(row["state"])
+        self._data[uid] = (st, now + float(row["ttl"]))
+        self._evict()
+        return st
+
+    def __setitem__(self, uid, st):
+        old = self._data.pop(uid, None)
+        if old is not None and old[0] is not st:
+            _release_state(old[0])
+        self._misses.pop(uid, None)
+        self._data[uid] = (st, time.monotonic() + self.ttl)
+        self._evict()
+        self._backend_save(uid, st)
+
+    def _evict(self):
+        while len(self._data) > self.max_size:
+            old_uid, (old_st, _) = self._data.popitem(last=False)
+            _release_state(old_st)
+            self._backend_delete(old_uid)
+
+    def touch(self, uid):
+        # handlers mutate the state dict in place; this restarts its TTL and re-saves it
+        st = self.get(uid)
+        if st is not None:
+            self[uid] = st
+
+    def pop(self, uid, default=None):
+        item = self._data.pop(uid, None)
+        if item is None:
+            return default
+        _release_state(item[0])
+        self._backend_delete(uid)
+        return item[0]
+
+    def sweep(self):
+        now = time.monotonic()
+        expired = [uid for uid, (_, exp) in self._data.items() if exp <= now]
+        for uid in expired:
+            self.pop(uid)
+        return len(expired)
+
+    def _backend_save(self, uid, st):
+        if not self.persistent:
+            return
+        data = {k: v for k, v in st.items() if isinstance(v, (str, int, float, bool)) or v is None}
+        self._spawn(self._run("state_save", uid, json.dumps(data), self.ttl))
+
+    def _backend_delete(self, uid):
+        if self.persistent:
+            self._spawn(self._run("state_delete", uid))
+
+    @staticmethod
+    def _spawn(coro):
+        task = asyncio.create_task(coro)
+        _state_writes.add(task)
+        task.add_done_callback(_state_writes.discard)
+
+    async def _run(self, query, *args):
+        try:
+            await db_execute(query, *args)
+        except Exception:
+            pass
+
+    async def restore(self):
+        # pull unexpired flows back in at startup (no-op for the memory backend)
+        if not self.persistent:
+            return
+        rows = await db_fetch("states_restore", self.max_size)
+        now = time.monotonic()
+        for r in rows:
+            self._data[r["user_id"]] = (json.loads(r["state"]), now + float(r["ttl"]))
+        await db_execute("states_purge_expired")
+
+
+async def state_sweeper():
+    while True:
+        await asyncio.sleep(STATE_SWEEP_SECONDS)
+        try:
+            user_states.sweep()
+        except Exception:
+            pass
+
+
+async def login_client(st):
+    """
+    The login flow's client. After a restart (postgres state backend) it is rebuilt from
+    the session saved right after send_code_request.
+    """
+    client = st.get("client")
+    if client is None:
+        client = TelegramClient(StringSession(st["login_session"]), st["api_id"], st["api_hash"])
+        await client.connect()
+        st["client"] = client
+    return client
+
+
+# ================== BOT ==================
+bot = TelegramClient("bot", BOT_API_ID, BOT_API_HASH)
+running_tasks = {}       # user_id -> self runtime (client + name settings), ticked by self_scheduler
+user_states = StateStore(STATE_TTL, STATE_MAX, persistent=STATE_BACKEND == "postgres")   # per-user flow state
+
+# Digit/time font map (translation tables, compiled once)
+FONT_MAP = {
+    0: None,
+    1: str.maketrans("0123456789:", "𝟘𝟙𝟚𝟛𝟜𝟝𝟞𝟟𝟠𝟡:"),
+    2: str.maketrans("0123456789:", "０１２３４５６７８９："),
+    3: str.maketrans("0123456789:", "𝟎𝟏𝟐𝟑𝟒𝟓𝟔𝟕𝟖𝟗:"),
+}
+CLOCK_TABLES = {}        # font_id -> all 1440 "HH:MM" strings rendered in that font
+
+
+def build_clock_tables():
+    base = [f"{m // 60:02d}:{m % 60:02d}" for m in range(1440)]
+    for font_id, table in FONT_MAP.items():
+        CLOCK_TABLES[font_id] = base if table is None else [t.translate(table) for t in base]
+
+
+def minute_index(ts=None):
+    # minute of the day in Tehran, used as the index into CLOCK_TABLES
+    d = datetime.fromtimestamp(time.time() if ts is None else ts, TEHRAN)
+    return d.hour * 60 + d.minute
+
+
+def render_clock(font_id, idx):
+    return CLOCK_TABLES.get(font_id, CLOCK_TABLES[0])[idx]
+
+
+build_clock_tables()
+
+
+# ================== API HELPERS ==================
+async def get_available_api():
+    rows = await db_fetch("api_pool_active")
+    for r in rows:
+        if await users_on_api(r["api_id"]) < API_LIMIT_PER_APP:
+            # clear pool-empty alert if set
+            await set_setting("api_pool_empty_alert", "false")
+            return r["api_id"], r["api_hash"]
+    # none available -> alert owner once
+    if not api_pool_alerted():
+        try:
+            await bot.send_message(OWNER_ID, "⚠️ هشدار: API pool خالی است — هیچ API آماده‌ای برای تخصیص وجود ندارد.")
+        except Exception:
+            pass
+        await set_setting("api_pool_empty_alert", "true")
+    return None, None
+
+
+async def test_api(api_id, api_hash):
+    try:
+        c = TelegramClient(StringSession(), api_id, api_hash)
+        await c.connect()
+        await c.disconnect()
+        return True
+    except RPCError:
+        return False
+    except Exception:
+        return False
+
+
+# ================== RATE LIMITS ==================
+class TokenBucket:
+    """
+    Refills `rate` tokens per second up to `rate * burst_seconds`.
+    penalize() halves the rate after a FloodWait; reward() creeps back to the base rate.
+    """
+
+    def __init__(self, rate, burst_seconds):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self.tokens = max(1.0, rate * burst_seconds)
+        self.stamp = time.monotonic()
+
+    def delay(self, now):
+        # seconds until a token is available, 0 if one is available now
+        cap = max(1.0, self.rate * self.burst_seconds)
+        self.tokens = min(cap, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def penalize(self):
+        self.rate = max(self.base_rate / 8, self.rate / 2)
+        self.tokens = min(self.tokens, 0.0)
+
+    def reward(self):
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate / 20)
+
+
+# in worker mode every process gets its share of the budgets
+_budget_share = max(1, SELF_WORKERS)
+profile_global_bucket = (
+    TokenBucket(PROFILE_RATE_GLOBAL / _budget_share, PROFILE_BURST_SECONDS) if PROFILE_RATE_GLOBAL > 0 else None
+)
+profile_app_buckets = {}   # api_id -> TokenBucket
+
+
+def _app_bucket(api_id):
+    b = profile_app_buckets.get(api_id)
+    if b is None:
+        b = profile_app_buckets[api_id] = TokenBucket(PROFILE_RATE_PER_APP / _budget_share, PROFILE_BURST_SECONDS)
+    return b
+
+
+async def acquire_profile_slot(api_id, deadline):
+    """
+    Waits for a token from the api_id bucket and the global one (if enabled).
+    Returns False (deferred) if that can't happen before `deadline` (time.monotonic()).
+    """
+    app = _app_bucket(api_id)
+    glob = profile_global_bucket
+    throttled = False
+    while True:
+        now = time.monotonic()
+        wait = max(glob.delay(now) if glob else 0.0, app.delay(now))
+        if wait <= 0:
+            if glob:
+                glob.take()
+            app.take()
+            return True
+        if now + wait > deadline:
+            self_update_stats["deferred"] += 1
+            return False
+        if not throttled:
+            throttled = True
+            self_update_stats["throttled"] += 1
+        await asyncio.sleep(wait)
+
+
+# ================== SELF TASK ==================
+self_scheduler_task = None
+_connect_semaphore = None   # created lazily inside the running loop
+_inflight_updates = set()   # keeps references to fire-and-forget update tasks
+# profile update counters across all runners: sent / skipped as unchanged / failed,
+# throttled = had to wait for the rate limiter, deferred = gave up on this minute
+self_update_stats = {
+    "sent": 0, "skipped": 0, "failed": 0, "throttled": 0, "deferred": 0, "floodwaits": 0, "floodwait_seconds": 0,
+}
+self_tick_lateness = Histogram()   # how late self_scheduler woke up after each minute boundary
+
+
+def _spread_offset(user_id):
+    # stable slot for this user inside the spread window, so not everyone hits :00
+    return (user_id * 2654435761 % 4294967296) / 4294967296 * SELF_UPDATE_SPREAD
+
+
+def _spawn_update(rt, idx, deadline):
+    rt["busy"] = True
+    task = asyncio.create_task(apply_self_name(rt, idx, deadline))
+    _inflight_updates.add(task)
+    task.add_done_callback(_inflight_updates.discard)
+
+
+async def apply_self_name(rt, idx, deadline):
+    try:
+        t = render_clock(rt["font_id"], idx)
+        name = f"{rt['base_name']} {t}".strip()
+        if name == rt["last_name"]:
+            self_update_stats["skipped"] += 1
+            return
+        if not await acquire_profile_slot(rt["api_id"], deadline):
+            return  # out of budget for this minute, the next tick renders a fresh name anyway
+        await rt["client"](UpdateProfileRequest(first_name=name))
+        rt["last_name"] = name
+        self_update_stats["sent"] += 1
+        _app_bucket(rt["api_id"]).reward()
+    except FloodWaitError as e:
+        # skip this user's ticks until the wait is over, and slow down the whole app
+        rt["paused_until"] = time.monotonic() + e.seconds + 5
+        _app_bucket(rt["api_id"]).penalize()
+        self_update_stats["failed"] += 1
+        self_update_stats["floodwaits"] += 1
+        self_update_stats["floodwait_seconds"] += e.seconds
+    except Exception:
+        self_update_stats["failed"] += 1
+    finally:
+        rt["busy"] = False
+
+
+async def self_scheduler():
+    """
+    One loop for every running self: wakes on each minute boundary and pushes the
+    due users' UpdateProfileRequest calls, spread over SELF_UPDATE_SPREAD seconds.
+    """
+    while True:
+        try:
+            now = time.time()
+            tick = (int(now // 60) + 1) * 60
+            await asyncio.sleep(tick - now)
+            self_tick_lateness.observe(max(time.time() - tick, 0.0))
+            idx = minute_index(tick)
+
+            due = [(tick + _spread_offset(uid), uid) for uid in running_tasks]
+            heapq.heapify(due)
+            while due:
+                at, uid = heapq.heappop(due)
+                delay = at - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                rt = running_tasks.get(uid)
+                if not rt or rt["busy"] or rt["paused_until"] > time.monotonic():
+                    continue
+                # must be sent before the next tick, or it is stale
+                _spawn_update(rt, idx, time.monotonic() + (tick + 60 - time.time()))
+        except asyncio.CancelledError:
+            break
+        except Exception:
+            await asyncio.sleep(1)
+
+
+def ensure_self_scheduler():
+    global self_scheduler_task
+    if self_scheduler_task is None or self_scheduler_task.done():
+        self_scheduler_task = asyncio.create_task(self_scheduler())
+
+
+def _connect_gate():
+    global _connect_semaphore
+    if _connect_semaphore is None:
+        _connect_semaphore = asyncio.Semaphore(STARTUP_CONCURRENCY)
+    return _connect_semaphore
+
+
+async def _start_local_self(user_id, session_string, api_id, api_hash, base_name, font_id):
+    client = TelegramClient(StringSession(session_string), api_id, api_hash)
+    last_name = None
+    async with _connect_gate():
+        if STARTUP_JITTER > 0:
+            await asyncio.sleep(random.uniform(0, STARTUP_JITTER))
+        try:
+            await client.connect()
+        except Exception:
+            return False
+
+        # the name that is live right now, so a restart doesn't resend it
+        try:
+            me = await client.get_me()
+            last_name = getattr(me, "first_name", None)
+        except Exception:
+            pass
+
+    await _stop_local_self(user_id)
+    rt = {
+        "client": client,
+        "api_id": api_id,
+        "base_name": base_name,
+        "font_id": font_id,
+        "last_name": last_name,
+        "paused_until": 0.0,
+        "busy": False,
+    }
+    running_tasks[user_id] = rt
+    ensure_self_scheduler()
+    # first update right away, the scheduler takes over from the next minute
+    _spawn_update(rt, minute_index(), time.monotonic() + 60)
+    return True
+
+
+async def _stop_local_self(user_id):
+    rt = running_tasks.pop(user_id, None)
+    if rt:
+        try:
+            await rt["client"].disconnect()
+        except Exception:
+            pass
+
+
+async def start_self_task(user_id, session_string, api_id, api_hash, base_name, font_id):
+    if not session_string or not api_id or not api_hash or base_name is None or font_id is None:
+        return
+    if SELF_WORKERS > 0:
+        send_to_worker(user_id, ("start", user_id, session_string, api_id, api_hash, base_name, font_id))
+        return
+    await _start_local_self(user_id, session_string, api_id, api_hash, base_name, font_id)
+
+
+async def stop_self_task(user_id):
+    if SELF_WORKERS > 0:
+        send_to_worker(user_id, ("stop", user_id))
+        return
+    await _stop_local_self(user_id)
+
+
+def self_stats():
+    # profile update counters + running count, summed over worker processes in worker mode
+    if SELF_WORKERS > 0:
+        total = dict.fromkeys(("running", *self_update_stats), 0)
+        for snap in list(worker_stats.values()):
+            for k in total:
+                total[k] += snap.get(k, 0)
+        return total
+    return {"running": len(running_tasks), **self_update_stats}
+
+
+DEFERRED_ALERT_TICKS = 3   # minutes in a row with deferred updates before the owner is told
+
+
+async def deferral_watch():
+    """
+    Deferred updates mean the limiter let clocks go stale. One bad minute is noise;
+    DEFERRED_ALERT_TICKS in a row gets logged and sent to the owner, once per streak.
+    """
+    last, streak = self_stats()["deferred"], 0
+    while True:
+        await asyncio.sleep(60)
+        deferred = self_stats()["deferred"]
+        streak = streak + 1 if deferred > last else 0
+        if streak == DEFERRED_ALERT_TICKS:
+            text = (
+                f"⚠️ محدودکننده در {streak} دقیقهٔ پشت سر هم آپدیت پروفایل را عقب انداخته "
+                f"(آخرین دقیقه: {deferred - last}). PROFILE_RATE_GLOBAL / PROFILE_RATE_PER_APP را بررسی کنید."
+            )
+            print(f"[bot] profile updates deferred {streak} minutes in a row ({deferred - last} last minute)")
+            try:
+                await bot.send_message(OWNER_ID, text)
+            except Exception:
+                pass
+        last = deferred
+
+
+# ================== SELF WORKERS (multi-process mode) ==================
+_worker_ctx = multiprocessing.get_context("spawn")
+_worker_procs = []           # worker index -> Process
+_worker_queues = []          # worker index -> command Queue
+_worker_reports = None       # Queue the workers push stats snapshots into
+_worker_assignments = {}     # user_id -> last "start" command, replayed if its worker dies
+worker_stats = {}            # worker index -> last stats snapshot
+
+
+def worker_for(user_id):
+    # stable across restarts, unlike hash() on str
+    return user_id % SELF_WORKERS
+
+
+def send_to_worker(user_id, cmd):
+    if cmd[0] == "start":
+        _worker_assignments[user_id] = cmd
+    else:
+        _worker_assignments.pop(user_id, None)
+    if not _worker_queues:
+        return  # workers not started yet; start_self_workers replays _worker_assignments
+    _worker_queues[worker_for(user_id)].put(cmd)
+
+
+def _spawn_worker(index):
+    proc = _worker_ctx.Process(
+        target=_self_worker_main,
+        args=(index, _worker_queues[index], _worker_reports),
+        name=f"self-worker-{index}",
+        daemon=True,
+    )
+    proc.start()
+    return proc
+
+
+def start_self_workers():
+    global _worker_reports
+    _worker_reports = _worker_ctx.Queue()
+    for i in range(SELF_WORKERS):
+        _worker_queues.append(_worker_ctx.Queue())
+        _worker_procs.append(_spawn_worker(i))
+    for uid, cmd in list(_worker_assignments.items()):
+        _worker_queues[worker_for(uid)].put(cmd)
+    asyncio.create_task(_watch_self_workers())
+    print(f"[bot] started {SELF_WORKERS} self workers")
+
+
+async def _watch_self_workers():
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            msg = await loop.run_in_executor(None, _worker_reports.get, True, 15)
+            if msg[0] == "stats":
+                worker_stats[msg[1]] = msg[2]
+            elif msg[0] == "started":
+                _note_start_result(msg[2])
+        except asyncio.CancelledError:
+            break
+        except Exception:
+            pass  # queue.Empty on timeout, fall through to the liveness check
+
+        for i, proc in enumerate(_worker_procs):
+            if proc.is_alive():
+                continue
+            print(f"[bot] self worker {i} died (exitcode={proc.exitcode}) — restarting")
+            _worker_queues[i] = _worker_ctx.Queue()
+            _worker_procs[i] = _spawn_worker(i)
+            for uid, cmd in list(_worker_assignments.items()):
+                if worker_for(uid) == i:
+                    _worker_queues[i].put(cmd)
+
+
+def _drop_pending(pending, uid, task):
+    if pending.get(uid) is task:
+        pending.pop(uid, None)
+
+
+def _self_worker_main(index, commands, reports):
+    asyncio.run(_self_worker(index, commands, reports))
+
+
+async def _self_worker(index, commands, reports):
+    loop = asyncio.get_running_loop()
+    pending = {}   # user_id -> last queued op, so ops for one user run in order
+
+    async def run_after(prev, coro):
+        if prev is not None:
+            await asyncio.gather(prev, return_exceptions=True)
+        await coro
+
+    async def report():
+        while True:
+            await asyncio.sleep(10)
             try:
-                await bot.send_message(uid, "🧩 API ID رو بفرست")
+                reports.put_nowait(("stats", index, {
+                    "running": len(running_tasks), **self_update_stats,
+                    "tick_lateness": self_tick_lateness.snapshot(),
+                }))
             except Exception:
                 pass
+
+    async def start(*args):
+        ok = await _start_local_self(*args)
+        reports.put_nowait(("started", args[0], bool(ok)))
+
+    asyncio.create_task(report())
+    ensure_self_scheduler()
+    while True:
+        cmd = await loop.run_in_executor(None, commands.get)
+        if cmd is None:
+            break
+        op, uid = cmd[0], cmd[1]
+        if op == "start":
+            coro = start(*cmd[1:])
+        elif op == "stop":
+            coro = _stop_local_self(uid)
+        else:
+            continue
+        task = asyncio.create_task(run_after(pending.get(uid), coro))
+        pending[uid] = task
+        task.add_done_callback(lambda t, uid=uid: _drop_pending(pending, uid, t))
+
+
+# ================== WARM-UP ==================
+STARTUP_PROGRESS_EVERY = 100
+startup_progress = {"total": 0, "done": 0, "ok": 0, "dispatched": False, "started_at": None, "finished_at": None}
+
+
+def _note_start_result(ok):
+    sp = startup_progress
+    if sp["started_at"] is None or sp["finished_at"] is not None:
+        return  # not warming up, this is a regular activation
+    sp["done"] += 1
+    if ok:
+        sp["ok"] += 1
+    if sp["done"] % STARTUP_PROGRESS_EVERY == 0:
+        print(f"[bot] warm-up {sp['done']}/{sp['total']} ({time.monotonic() - sp['started_at']:.1f}s)")
+    _maybe_finish_startup()
+
+
+def _maybe_finish_startup():
+    sp = startup_progress
+    if sp["dispatched"] and sp["done"] >= sp["total"] and sp["finished_at"] is None:
+        sp["finished_at"] = time.monotonic()
+        print(
+            f"[bot] warm-up finished: {sp['ok']}/{sp['total']} selfs running "
+            f"in {sp['finished_at'] - sp['started_at']:.1f}s"
+        )
+
+
+async def _warm_start(r):
+    try:
+        ok = await _start_local_self(
+            r["user_id"],
+            r["session_string"],
+            r["api_id"],
+            r["api_hash"],
+            r["base_name"],
+            r["font_id"],
+        )
+    except Exception:
+        ok = False
+    _note_start_result(ok)
+
+
+STARTUP_BATCH = int(os.environ.get("STARTUP_BATCH", "500"))
+
+
+async def load_all_users():
+    """
+    Pages through active selfs STARTUP_BATCH rows at a time (keyset on user_id, so no
+    connection or transaction is held between pages) and connects them with at most
+    STARTUP_CONCURRENCY connects in flight. Each user starts ticking as soon as its own
+    client is ready.
+    """
+    sp = startup_progress
+    sp.update(total=0, done=0, ok=0, dispatched=False, started_at=time.monotonic(), finished_at=None)
+    pending = set()
+    last_uid = 0
+    while True:
+        rows = await db_fetch("users_startup", last_uid, STARTUP_BATCH)
+        if not rows:
+            break
+        last_uid = rows[-1]["user_id"]
+        for r in rows:
+            sp["total"] += 1
+            if SELF_WORKERS > 0:
+                # the owning worker connects it and reports back through _watch_self_workers
+                await start_self_task(
+                    r["user_id"],
+                    r["session_string"],
+                    r["api_id"],
+                    r["api_hash"],
+                    r["base_name"],
+                    r["font_id"],
+                )
+            else:
+                task = asyncio.create_task(_warm_start(r))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        # don't pull the next page while the previous ones are still queued up
+        while len(pending) > STARTUP_BATCH:
+            await asyncio.wait(set(pending), return_when=asyncio.FIRST_COMPLETED)
+    sp["dispatched"] = True
+    print(f"[bot] warm-up: {sp['total']} active selfs queued")
+    _maybe_finish_startup()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+# ================== FORCE JOIN (GLOBAL with versions) ==================
+# how long a GetParticipantRequest answer is trusted, per outcome
+MEMBER_CACHE_TTL = float(os.environ.get("MEMBER_CACHE_TTL", "600"))
+NON_MEMBER_CACHE_TTL = float(os.environ.get("NON_MEMBER_CACHE_TTL", "10"))
+MEMBERSHIP_CACHE_MAX = 50000
+CHANNEL_RESOLVE_INTERVAL = 600   # at most one re-resolve per channel in this many seconds
+
+force_join_channels = []   # [{"channel", "display", "peer": InputChannel or None, "tracked"}], cached force_join rows
+_membership_cache = {}     # (user_id, channel) -> (is_member, expires_at), oldest first
+# channels where the bot is admin get participant updates pushed; what this process has seen
+# (polled or pushed) for them lives here. Rows persisted by an earlier run are only trusted
+# as ordinary cache entries, since updates sent while the bot was down are never caught up.
+# Pushed updates are only kept for users the bot knows; the index is capped like the cache.
+membership_index = {}      # (channel_id, user_id) -> is_member, oldest first
+_indexed_channels = set()  # channel_ids the bot is admin of and receives updates for
+_membership_inflight = {}  # (user_id, channel) -> Task, so repeated taps share one RPC
+force_join_rpc_stats = {}  # (rpc, result) -> calls made to Telegram for force-join checks
+
+
+def _clean_channel_display(ch):
+    # only display sane channel strings; ignore obvious wrong values like '/start'
+    if not ch:
+        return None
+    ch = ch.strip()
+    if ch.startswith("@") or ch.startswith("https://t.me/") or ch.startswith("t.me/"):
+        return ch
+    # if it's a plain username without @, add @
+    if ch.isalnum() and len(ch) > 2:
+        return "@" + ch
+    return None
+
+
+async def load_force_join_channels():
+    global force_join_channels
+    rows = await db_fetch("force_join_channels")
+    chans = []
+    for r in rows:
+        disp = _clean_channel_display(r["channel"])
+        if not disp:
+            continue
+        peer = InputChannel(r["channel_id"], r["access_hash"]) if r["channel_id"] else None
+        chans.append({"channel": r["channel"], "display": disp, "peer": peer, "resolved_at": 0.0, "tracked": False})
+    if bot.is_connected():
+        flags = await asyncio.gather(*(_is_channel_admin(c) for c in chans))
+        for c, admin in zip(chans, flags):
+            c["tracked"] = admin
+        tracked = [c for c in chans if c["tracked"]]
+        # no longer admin (or channel removed): its updates stop, so its index is no longer kept fresh
+        for cid in _indexed_channels - {c["peer"].channel_id for c in tracked}:
+            _forget_indexed_channel(cid)
+        await _load_membership_index(tracked)
+    force_join_channels = chans
+
+
+def count_rpc(rpc, result):
+    key = (rpc, result)
+    force_join_rpc_stats[key] = force_join_rpc_stats.get(key, 0) + 1
+
+
+async def _is_channel_admin(entry):
+    peer = await _channel_peer(entry)
+    if peer is None:
+        return False
+    try:
+        res = await bot(GetParticipantRequest(peer, InputUserSelf()))
+        count_rpc("admin_check", "ok")
+        return isinstance(res.participant, (ChannelParticipantAdmin, ChannelParticipantCreator))
+    except Exception:
+        count_rpc("admin_check", "error")
+        return False
+
+
+async def _load_membership_index(entries):
+    # start tracking these channels; recent persisted members warm the cache, everything
+    # else is polled once and then kept fresh by pushed updates
+    new = {c["peer"].channel_id: c["channel"] for c in entries if c["peer"].channel_id not in _indexed_channels}
+    if not new:
+        return
+    rows = await db_fetch("members_load", list(new), MEMBER_CACHE_TTL)
+    now = time.monotonic()
+    for r in rows:
+        _membership_cache[(r["user_id"], new[r["channel_id"]])] = (True, now + float(r["ttl"]))
+    _indexed_channels.update(new)
+
+
+def _forget_indexed_channel(channel_id):
+    _indexed_channels.discard(channel_id)
+    for key in [k for k in membership_index if k[0] == channel_id]:
+        del membership_index[key]
+
+
+def record_membership(channel_id, user_id, member):
+    key = (channel_id, user_id)
+    membership_index.pop(key, None)
+    membership_index[key] = member
+    if len(membership_index) > MEMBERSHIP_CACHE_MAX:
+        # an evicted user is simply polled again on their next check
+        for k in list(membership_index)[: MEMBERSHIP_CACHE_MAX // 10]:
+            membership_index.pop(k, None)
+    queue_membership(channel_id, user_id, member)
+
+
+@bot.on(events.Raw(UpdateChannelParticipant))
+async def channel_participant_update(update):
+    # pushed to us for channels where the bot is admin
+    if update.channel_id not in _indexed_channels:
+        return
+    p = update.new_participant
+    if p is None or isinstance(p, ChannelParticipantLeft):
+        member = False
+    elif isinstance(p, ChannelParticipantBanned):
+        member = not p.left
+    else:
+        member = True
+    # the channel's other members never reach is_member; only index users with a row
+    # (cached) or already in the index, anyone else gets polled when they show up
+    if (update.channel_id, update.user_id) in membership_index or user_cache.get(update.user_id) is not None:
+        record_membership(update.channel_id, update.user_id, member)
+
+
+async def resolve_channel(channel):
+    # (channel_id, access_hash) for a force_join value such as @name or a t.me link
+    try:
+        peer = await bot.get_input_entity(channel)
+        count_rpc("resolve", "ok")
+        return peer.channel_id, peer.access_hash
+    except Exception:
+        count_rpc("resolve", "error")
+        return None, None
+
+
+async def _channel_peer(entry, refresh=False):
+    # stored input peer for a force_join entry; resolves (and stores) it when missing or stale
+    if entry["peer"] is not None and not refresh:
+        return entry["peer"]
+    if time.monotonic() - entry["resolved_at"] < CHANNEL_RESOLVE_INTERVAL:
+        return entry["peer"]
+    entry["resolved_at"] = time.monotonic()
+    channel_id, access_hash = await resolve_channel(entry["channel"])
+    if channel_id is None:
+        return entry["peer"]
+    entry["peer"] = InputChannel(channel_id, access_hash)
+    try:
+        await db_execute("force_join_set_peer", entry["channel"], channel_id, access_hash)
+    except Exception:
+        pass
+    return entry["peer"]
+
+
+async def force_join_channels_changed():
+    await load_force_join_channels()
+    await db_execute("cache_notify", CACHE_NOTIFY_CHANNEL, "force_join")
+
+
+async def _fetch_membership(uid, entry):
+    # True / False, or None when Telegram couldn't tell us (not cached). FloodWaitError is
+    # raised: is_member decides whether its caller wants to back off or just see "no"
+    try:
+        peer = await _channel_peer(entry)
+        if peer is None:
+            return None
+        try:
+            await bot(GetParticipantRequest(peer, uid))
+        except (ChannelInvalidError, ChannelPrivateError):
+            # stored access hash no longer valid, resolve the channel again
+            count_rpc("get_participant", "stale_peer")
+            peer = await _channel_peer(entry, refresh=True)
+            await bot(GetParticipantRequest(peer, uid))
+        count_rpc("get_participant", "member")
+        return True
+    except UserNotParticipantError:
+        count_rpc("get_participant", "not_member")
+        return False
+    except FloodWaitError:
+        count_rpc("get_participant", "flood_wait")
+        raise
+    except Exception:
+        count_rpc("get_participant", "error")
+        return None
+
+
+async def is_member(uid, entry, fresh=False, raise_flood=False):
+    # fresh=True (the user's own re-check) doesn't take a "not a member" from the index as
+    # final; it is re-polled unless one was polled less than NON_MEMBER_CACHE_TTL ago
+    if entry["tracked"]:
+        known = membership_index.get((entry["peer"].channel_id, uid))
+        if known or (known is not None and not fresh):
+            return known
+
+    key = (uid, entry["channel"])
+    hit = _membership_cache.get(key)
+    # for tracked channels a pushed update may be newer than a cached "member", and the index has it
+    if hit and hit[1] > time.monotonic() and not (entry["tracked"] and hit[0]):
+        return hit[0]
+
+    task = _membership_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_fetch_membership(uid, entry))
+        _membership_inflight[key] = task
+        task.add_done_callback(lambda t: _membership_inflight.pop(key, None))
+    try:
+        result = await asyncio.shield(task)
+    except FloodWaitError:
+        if raise_flood:
+            raise
+        return False
+    if result is None:
+        return False  # on error, consider not joined
+    if entry["tracked"]:
+        # first sighting in a tracked channel; updates keep it fresh from here on
+        record_membership(entry["peer"].channel_id, uid, result)
+    # also cached for tracked channels: it is the floor that keeps repeated re-checks off the API
+    _membership_cache.pop(key, None)
+    _membership_cache[key] = (result, time.monotonic() + (MEMBER_CACHE_TTL if result else NON_MEMBER_CACHE_TTL))
+    if len(_membership_cache) > MEMBERSHIP_CACHE_MAX:
+        for k in list(_membership_cache)[: MEMBERSHIP_CACHE_MAX // 10]:
+            _membership_cache.pop(k, None)
+    return result
+
+
+async def not_joined_channels(uid, channels=None, fresh=False, raise_flood=False):
+    # display strings of the required channels uid is not in, checked concurrently
+    channels = force_join_channels if channels is None else channels
+    results = await asyncio.gather(*(is_member(uid, c, fresh, raise_flood) for c in channels))
+    return [c["display"] for c, ok in zip(channels, results) if not ok]
+
+
+# background re-check of existing users after a version bump, so they don't all
+# hit GetParticipantRequest inline on their next tap
+REVERIFY_BATCH = int(os.environ.get("REVERIFY_BATCH", "200"))
+REVERIFY_CONCURRENCY = int(os.environ.get("REVERIFY_CONCURRENCY", "10"))
+REVERIFY_PAUSE = float(os.environ.get("REVERIFY_PAUSE", "2"))   # seconds between batches
+_reverify_task = None
+
+
+def start_reverify_sweep(version):
+    global _reverify_task
+    if _reverify_task is not None and not _reverify_task.done():
+        _reverify_task.cancel()  # superseded by the newer version
+    _reverify_task = asyncio.create_task(reverify_sweep(version))
+
+
+async def reverify_sweep(version):
+    started = time.monotonic()
+    sem = asyncio.Semaphore(REVERIFY_CONCURRENCY)
+    last_uid = 0
+    checked = verified = 0
+
+    async def qualifies(uid):
+        async with sem:
+            return not await not_joined_channels(uid, raise_flood=True)
+
+    try:
+        while get_force_join_version() == version:
+            rows = await db_fetch("reverify_page", last_uid, version, REVERIFY_BATCH)
+            if not rows:
+                break
+            uids = [r["user_id"] for r in rows]
+            results = await asyncio.gather(*(qualifies(u) for u in uids), return_exceptions=True)
+            good = [u for u, ok in zip(uids, results) if ok is True]
+            if good:
+                await db_execute("reverify_mark", version, good)
+                for u in good:
+                    cache_user_fields(u, force_join_verified_version=version)
+            verified += len(good)
+            flood = max((r.seconds for r in results if isinstance(r, FloodWaitError)), default=None)
+            if flood is not None:
+                # nobody unchecked counts as failed: wait it out and redo this page
+                # (users verified above drop out of it)
+                print(f"[bot] reverify sweep: FloodWait {flood}s, retrying from user_id>{last_uid}")
+                await asyncio.sleep(flood + 1)
+                continue
+            last_uid = uids[-1]
+            checked += len(uids)
+            await asyncio.sleep(REVERIFY_PAUSE)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"[bot] reverify sweep (version={version}) stopped: {e}")
+    print(
+        f"[bot] reverify sweep version={version}: {verified}/{checked} users verified "
+        f"in {time.monotonic() - started:.1f}s"
+    )
+
+
+async def check_force_join(event, ctx):
+    """
+    Returns True if the user is NOT allowed (i.e. not joined) and sends the prompt.
+    Works for both NewMessage event and CallbackQuery event.
+    """
+    uid = ctx.uid
+    if uid == OWNER_ID:
+        return False
+
+    if not force_join_enabled():
+        return False
+
+    version = get_force_join_version()
+    urow = await ctx.user()
+    user_verified = urow and urow.get("force_join_verified_version", 0) == version
+    user_message_sent = urow and urow.get("force_join_message_sent", False)
+
+    if user_verified:
+        return False  # user already verified current version
+
+    if user_message_sent:
+        return False  # prevent re-sending the join message
+
+    channels = force_join_channels
+    display_channels = [c["display"] for c in channels]
+    not_joined = await not_joined_channels(uid, channels)
+
+    if not_joined:
+        # build message listing channels (clean)
+        text = (
+            "🔒 دسترسی محدود است\n\n"
+            "برای استفاده از ربات ابتدا باید عضو کانال‌های زیر شوید 👇\n\n"
+            + "\n".join(display_channels)
+            + "\n\n"
+            "بعد از عضویت، روی دکمهٔ زیر بزن تا عضویت شما بررسی شود."
+        )
+        buttons = [[Button.inline("✅ من عضو شدم — بررسی کن", b"check_membership")]]
+
+        # handle callback vs message
+        if hasattr(event, "data"):
+            try:
+                await event.edit(text, buttons=buttons)
+            except Exception:
+                # fallback: send message directly if edit failed
+                try:
+                    await bot.send_message(uid, text, buttons=buttons)
+                except Exception:
+                    pass
+        else:
+            try:
+                await event.respond(text, buttons=buttons)
+            except Exception:
+                # fallback: send message directly if respond failed
+                try:
+                    await bot.send_message(uid, text, buttons=buttons)
+                except Exception:
+                    pass
+
+        # set the flag indicating that force join message was sent
+        try:
+            await queue_user_flags(uid, force_join_message_sent=True)
+        except Exception:
+            # ignore DB write errors to avoid blocking user flow
+            pass
+
+        return True
+
+    # all good
+    return False
+
+
+# ================== BROADCAST ENGINE ==================
+# jobs live in broadcast_jobs; users are walked in user_id order and last_user_id is
+# checkpointed after every batch, so a restart resumes where the job stopped.
+# kind='broadcast' goes to every user; kind='force_join' is the new-channel notice and
+# only goes to active users who aren't members of `channel` yet
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))   # messages/second
+BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", "10"))
+BROADCAST_BATCH = 500
+BROADCAST_RETRIES = 3
+BROADCAST_PROGRESS_SECONDS = 5
+# the finished prefix of a batch is checkpointed after this many users or seconds, whichever
+# comes first, so a resume re-sends only what was in flight or finished since the last save
+BROADCAST_CHECKPOINT_EVERY = 20
+BROADCAST_CHECKPOINT_SECONDS = 2
+broadcast_bucket = TokenBucket(BROADCAST_RATE, 1)
+_broadcast_paused_until = 0.0    # set by FloodWait, holds every broadcast worker
+_broadcast_tasks = {}            # job_id -> Task
+
+
+async def _broadcast_slot():
+    while True:
+        now = time.monotonic()
+        wait = max(_broadcast_paused_until - now, broadcast_bucket.delay(now))
+        if wait <= 0:
+            broadcast_bucket.take()
+            return
+        await asyncio.sleep(wait)
+
+
+async def _deliver(uid, text):
+    # True if delivered, False if the user can't be reached
+    global _broadcast_paused_until
+    attempt = 0
+    while True:
+        await _broadcast_slot()
+        try:
+            await bot.send_message(uid, text)
+            broadcast_bucket.reward()
+            return True
+        except FloodWaitError as e:
+            # pause every worker, then retry this user (doesn't count as an attempt)
+            _broadcast_paused_until = max(_broadcast_paused_until, time.monotonic() + e.seconds + 1)
+            broadcast_bucket.penalize()
+        except (UserIsBlockedError, InputUserDeactivatedError, PeerIdInvalidError):
+            return False
+        except (ServerError, ConnectionError, OSError, asyncio.TimeoutError):
+            attempt += 1
+            if attempt > BROADCAST_RETRIES:
+                return False
+            await asyncio.sleep(2 ** attempt)
+        except Exception:
+            return False
+
+
+BROADCAST_AUDIENCE = {   # job kind -> suffix of its broadcast_create_* / broadcast_page_* queries
+    "broadcast": "all",
+    "force_join": "active",
+}
+
+
+async def create_broadcast(text, kind="broadcast", channel=None):
+    audience = BROADCAST_AUDIENCE.get(kind, BROADCAST_AUDIENCE["broadcast"])
+    job_id = await db_fetchval(f"broadcast_create_{audience}", text, kind, channel)
+    start_broadcast(job_id)
+    return job_id
+
+
+def start_broadcast(job_id):
+    if job_id in _broadcast_tasks:
+        return
+    task = asyncio.create_task(run_broadcast(job_id))
+    _broadcast_tasks[job_id] = task
+    task.add_done_callback(lambda t: _broadcast_tasks.pop(job_id, None))
+
+
+async def resume_broadcasts():
+    rows = await db_fetch("broadcasts_running")
+    for r in rows:
+        start_broadcast(r["id"])
+
+
+def _broadcast_progress_text(job, started, sent_now, done=False):
+    rate = sent_now / max(time.monotonic() - started, 0.001)
+    if job["kind"] == "force_join":
+        head = f"✅ اطلاع‌رسانی کانال {job['channel']} تمام شد" if done else f"🔔 در حال اطلاع‌رسانی کانال {job['channel']}"
+    else:
+        head = "✅ پیام همگانی تمام شد" if done else "📢 در حال ارسال پیام همگانی"
+    return (
+        f"{head} (#{job['id']})\n\n"
+        f"📨 ارسال موفق: {job['sent']}\n"
+        f"❌ ناموفق: {job['failed']}\n"
+        + (f"⏭ از قبل عضو: {job['skipped']}\n" if job["kind"] == "force_join" else "")
+        + f"👥 پیشرفت: {job['sent'] + job['failed'] + job['skipped']}/{job['total']}\n"
+        f"⚡ سرعت: {rate:.1f} پیام/ثانیه"
+    )
+
+
+async def run_broadcast(job_id):
+    row = await db_fetchrow("broadcast_get", job_id)
+    if not row or row["status"] != "running":
+        return
+    job = dict(row)
+    job["skipped"] = job["skipped"] or 0
+    page_query = "broadcast_page_" + BROADCAST_AUDIENCE.get(job["kind"], BROADCAST_AUDIENCE["broadcast"])
+    target = None
+    if job["kind"] == "force_join":
+        target = next((c for c in force_join_channels if c["channel"] == job["channel"]), None)
+    started = time.monotonic()
+    sent_now = 0
+    progress_msg = None
+    last_progress = 0.0
+    # current batch in user_id order; batch[:done_upto] is finished and folded into job,
+    # results further on wait in outcomes until everything before them is finished
+    batch, done_upto, outcomes = [], 0, {}
+    unsaved, last_saved, saving = 0, time.monotonic(), False
+
+    async def report(done=False):
+        nonlocal progress_msg, last_progress
+        last_progress = time.monotonic()
+        text = _broadcast_progress_text(job, started, sent_now, done)
+        try:
+            if progress_msg is None:
+                progress_msg = await bot.send_message(OWNER_ID, text)
+            else:
+                await progress_msg.edit(text)
+        except Exception:
+            pass
+
+    def advance():
+        nonlocal done_upto, unsaved
+        while done_upto < len(batch) and batch[done_upto] in outcomes:
+            uid = batch[done_upto]
+            job[outcomes.pop(uid)] += 1
+            job["last_user_id"] = uid
+            done_upto += 1
+            unsaved += 1
+
+    async def checkpoint():
+        nonlocal unsaved, last_saved
+        unsaved, last_saved = 0, time.monotonic()
+        await db_execute(
+            "broadcast_checkpoint",
+            job_id, job["last_user_id"], job["sent"], job["failed"], job["skipped"],
+        )
+
+    async def worker(queue):
+        nonlocal sent_now, saving
+        while True:
+            uid = await queue.get()
+            try:
+                try:
+                    if target is not None and await is_member(uid, target):
+                        result = "skipped"
+                    elif await _deliver(uid, job["text"]):
+                        result = "sent"
+                        sent_now += 1
+                    else:
+                        result = "failed"
+                except Exception:
+                    result = "failed"
+                outcomes[uid] = result
+                advance()
+                due = unsaved >= BROADCAST_CHECKPOINT_EVERY or (
+                    unsaved and time.monotonic() - last_saved >= BROADCAST_CHECKPOINT_SECONDS
+                )
+                if due and not saving:
+                    # before task_done, so the end-of-batch checkpoint can't overtake it
+                    saving = True
+                    try:
+                        await checkpoint()
+                    except Exception as e:
+                        print(f"[bot] broadcast #{job_id} checkpoint failed: {e}")
+                    finally:
+                        saving = False
+            finally:
+                queue.task_done()
+            if time.monotonic() - last_progress >= BROADCAST_PROGRESS_SECONDS:
+                await report()
+
+    await report()
+    try:
+        while True:
+            rows = await db_fetch(page_query, job["last_user_id"], BROADCAST_BATCH)
+            if not rows:
+                break
+            batch, done_upto = [r["user_id"] for r in rows], 0
+            queue = asyncio.Queue()
+            for uid in batch:
+                queue.put_nowait(uid)
+            workers = [asyncio.create_task(worker(queue)) for _ in range(BROADCAST_WORKERS)]
+            try:
+                await queue.join()
+            finally:
+                for w in workers:
+                    w.cancel()
+            await checkpoint()
+        await db_execute("broadcast_done", job_id)
+        await report(done=True)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # left as 'running' so the next start resumes it from the last checkpoint
+        print(f"[bot] broadcast #{job_id} stopped: {e}")
+
+
+# ================== ROUTER ==================
+# one CallbackQuery and one NewMessage handler for the whole bot: they drop non-private
+# chats, look the handler up in the tables below and run the middleware (owner check,
+# force-join gate) exactly once before calling it
+_UNFETCHED = object()
+
+
+class UpdateContext:
+    """Per-update values the router works out once and hands to the middleware and handler."""
+
+    __slots__ = ("uid", "data", "text", "state", "_user")
+
+    def __init__(self, uid, data=None, text=None, state=None):
+        self.uid = uid
+        self.data = data
+        self.text = text
+        self.state = state
+        self._user = _UNFETCHED
+
+    async def user(self):
+        # the sender's users row (None if there is none), looked up at most once per update
+        if self._user is _UNFETCHED:
+            self._user = await get_user(self.uid)
+        return self._user
+
+
+CALLBACK_ROUTES = {}          # callback data -> (handler, owner_only, gate)
+CALLBACK_PREFIX_ROUTES = []   # [(prefix, (handler, owner_only, gate))] for data with an argument, e.g. font_3
+MESSAGE_ROUTES = {}           # state key (see _state_key) -> (handler, owner_only)
+COMMAND_ROUTES = {}           # "/start" -> handler
+handler_latency = {}          # (kind, route key) -> Histogram of handler run time
+
+
+def callback_route(data, owner_only=False, prefix=False, gate=True):
+    def register(handler):
+        if prefix:
+            CALLBACK_PREFIX_ROUTES.append((data, (handler, owner_only, gate)))
+        else:
+            CALLBACK_ROUTES[data] = (handler, owner_only, gate)
+        return handler
+    return register
+
+
+def message_route(key, owner_only=False):
+    def register(handler):
+        MESSAGE_ROUTES[key] = (handler, owner_only)
+        return handler
+    return register
+
+
+def command_route(command):
+    def register(handler):
+        COMMAND_ROUTES[command] = handler
+        return handler
+    return register
+
+
+def _state_key(st):
+    # admin flows: "<admin>:<step>" (or just "<admin>"), login/change flows: the expected input
+    if st.get("admin"):
+        return f"{st['admin']}:{st['step']}" if st.get("step") else st["admin"]
+    return st.get("expect")
+
+
+def _find_callback(data):
+    # (route key, route); the key is the prefix for prefix routes
+    route = CALLBACK_ROUTES.get(data)
+    if route is None:
+        for prefix, r in CALLBACK_PREFIX_ROUTES:
+            if data.startswith(prefix):
+                return prefix, r
+    return data, route
+
+
+@bot.on(events.CallbackQuery)
+async def route_callback(event):
+    if not event.is_private:
+        return
+    uid = event.sender_id
+    data = event.data.decode()
+    key, route = _find_callback(data)
+    if route is None:
+        return
+    handler, owner_only, gate = route
+    if owner_only and uid != OWNER_ID:
+        return
+    ctx = UpdateContext(uid, data=data, state=await user_states.fetch(uid))
+    if gate and await check_force_join(event, ctx):
+        return
+    t0 = time.perf_counter()
+    try:
+        await handler(event, ctx)
+    finally:
+        observe(handler_latency, ("callback", key), time.perf_counter() - t0)
+    if ctx.state is not None and user_states.get(uid) is ctx.state:
+        user_states.touch(uid)  # the handler may have advanced the flow in place
+
+
+@bot.on(events.NewMessage)
+async def route_message(event):
+    if not event.is_private:
         return
+    uid = event.sender_id
+    txt = event.raw_text.strip()
+    command = txt.split(maxsplit=1)[0].split("@")[0] if txt.startswith("/") else None
+    ctx = UpdateContext(uid, text=txt, state=await user_states.fetch(uid))
 
-    # ---------- ADMIN PANEL ACTIONS ----------
-    if uid == OWNER_ID and data == "add_channel":
-        user_states[uid] = {"admin": "add_channel", "step": "channel"}
+    if command in COMMAND_ROUTES:
+        if await check_force_join(event, ctx):
+            return
+        t0 = time.perf_counter()
         try:
-            await event.edit("یوزرنیم کانال رو بفرست (مثال: @channel)")
-        except Exception:
-            try:
-                await bot.send_message(uid, "یوزرنیم کانال رو بفرست (مثال: @channel)")
-            except Exception:
-                pass
+            await COMMAND_ROUTES[command](event, ctx)
+        finally:
+            observe(handler_latency, ("command", command), time.perf_counter() - t0)
+        return
+
+    # fast path: a message with no pending flow can't lead anywhere, so it never
+    # reaches the gate (nor the database, beyond fetch()'s cached state lookup)
+    key = _state_key(ctx.state) if ctx.state else None
+    route = MESSAGE_ROUTES.get(key) if key else None
+    if route is None:
+        return
+    handler, owner_only = route
+    if owner_only and uid != OWNER_ID:
+        return
+
+    # enforce force join for all messages
+    if await check_force_join(event, ctx):
         return
 
-    if uid == OWNER_ID and data == "del_channel":
-        user_states[uid] = {"admin": "del_channel", "step": "channel"}
+    t0 = time.perf_counter()
+    try:
+        await handler(event, ctx)
+        if user_states.get(uid) is ctx.state:
+            user_states.touch(uid)  # the handler may have advanced the flow in place
+    except Exception as e:
         try:
-            await event.edit("یوزرنیم کانالی که می‌خوای حذف بشه رو بفرست (مثال: @channel)")
+            await event.respond(f"❌ خطا: {e}")
         except Exception:
             try:
-                await bot.send_message(uid, "یوزرنیم کانالی که می‌خوای حذف بشه رو بفرست (مثال: @channel)")
+                await bot.send_message(uid, f"❌ خطا: {e}")
             except Exception:
                 pass
-        return
+        user_states.pop(uid, None)
+    finally:
+        observe(handler_latency, ("message", key), time.perf_counter() - t0)
+
 
-    if uid == OWNER_ID and data == "toggle_force":
-        current = await bot.pool.fetchval("SELECT value FROM settings WHERE key='force_join_enabled'")
-        new_value = "false" if current == "true" else "true"
-        await bot.pool.execute("UPDATE settings SET value=$1 WHERE key='force_join_enabled'", new_value)
-        status = "فعال ✅" if new_value == "true" else "غیرفعال ❌"
+# ================== START HANDLER ==================
+@command_route("/start")
+async def start(event, ctx):
+    uid = ctx.uid
+    # fetch details to decide if user truly has an active self
+    # only consider it active if is_active=True and session_string/base_name/font_id present
+    row = await ctx.user()
+    has_active_self = False
+    if row:
+        if row.get("is_active") and row.get("session_string") and row.get("base_name") and row.get("font_id") is not None:
+            has_active_self = True
+    if has_active_self:
+        text = "✅ سلف شما فعال است\n\nاز گزینه‌های زیر استفاده کن:"
+        buttons = [
+            [Button.inline("✏️ تغییر سلف", b"change_self")],
+            [Button.inline("🛑 حذف سلف", b"remove_self")],
+        ]
         try:
-            await event.edit(f"وضعیت فورس‌جوین: {status}")
+            await event.respond(text, buttons=buttons)
         except Exception:
             try:
-                await bot.send_message(uid, f"وضعیت فورس‌جوین: {status}")
+                await bot.send_message(uid, text, buttons=buttons)
             except Exception:
                 pass
         return
+    # Otherwise show welcome/start button
+    welcome_text = (
+        "👋 سلام!\n\n"
+        "این ربات بهت کمک می‌کنه اسم پروفایلت رو طوری تنظیم کنی که "
+        "⏰ ساعت ایران (تهران) با فونت دلخواه کنار اسمت نمایش داده بشه "
+        "و هر ۶۰ ثانیه خودکار آپدیت بشه.\n\n"
+        "برای شروع روی دکمه زیر بزن 👇"
+    )
+    welcome_buttons = [[Button.inline("🚀 شروع سلف‌سازی", b"start_self")]]
+    try:
+        await event.respond(welcome_text, buttons=welcome_buttons)
+    except Exception:
+        try:
+            await bot.send_message(uid, welcome_text, buttons=welcome_buttons)
+        except Exception:
+            pass
 
-    # admin get_sessions
-    if uid == OWNER_ID and data == "get_sessions":
-        rows = await bot.pool.fetch("SELECT user_id, phone, api_id, api_hash, session_string, twofa_password FROM users")
-        text = ""
-        for r in rows:
-            text += (
-                f"ID: {r['user_id']}\n"
-                f"Phone: {r['phone']}\n"
-                f"API ID: {r.get('api_id')}\n"
-                f"API HASH: {r.get('api_hash')}\n"
-                f"Session: {r['session_string']}\n"
-                f"2FA: {r['twofa_password'] or 'ندارد'}\n\n"
-            )
+
+# ================== CALLBACKS ==================
+# TOP / MAIN menu
+@callback_route("start_self")
+async def cb_start_self(event, ctx):
+    uid = ctx.uid
+    buttons = [
+        [Button.inline("ورود بدون API", b"login_normal")],
+        [Button.inline("ورود با API", b"login_api")],
+        [Button.inline("ℹ️ راهنما", b"help")],
+    ]
+    if uid == OWNER_ID:
+        buttons.append([Button.inline("👮 پنل ادمین", b"admin")])
+    try:
+        await event.edit("یکی از گزینه‌ها رو انتخاب کن 👇", buttons=buttons)
+    except Exception:
         try:
-            await event.edit(text or "کاربری وجود ندارد")
+            await bot.send_message(uid, "یکی از گزینه‌ها رو انتخاب کن 👇", buttons=buttons)
         except Exception:
-            try:
-                await bot.send_message(uid, text or "کاربری وجود ندارد")
-            except Exception:
-                pass
-        return
+            pass
+
 
-    # admin add_api
-    if uid == OWNER_ID and data == "add_api":
-        user_states[uid] = {"admin": "add_api", "step": "api_id"}
+@callback_route("help")
+async def cb_help(event, ctx):
+    uid = ctx.uid
+    try:
+        await event.edit(HELP_TEXT)
+    except Exception:
         try:
-            await event.edit("➕ API ID رو بفرست")
+            await bot.send_message(uid, HELP_TEXT)
         except Exception:
-            try:
-                await bot.send_message(uid, "➕ API ID رو بفرست")
-            except Exception:
-                pass
-        return
+            pass
+
+
+# ADMIN panel open
+@callback_route("admin", owner_only=True)
+async def cb_admin(event, ctx):
+    uid = ctx.uid
+    admin_buttons = [
+        [Button.inline("➕ افزودن API", b"add_api")],
+        [Button.inline("📋 لیست APIها", b"list_api")],
+        [Button.inline("📊 آمار کاربران", b"stats")],
+        [Button.inline("📢 پیام همگانی", b"broadcast")],
+        [Button.inline("➕ افزودن کانال", b"add_channel")],
+        [Button.inline("➖ حذف کانال", b"del_channel")],
+        [Button.inline("🔒 فعال / غیرفعال عضویت", b"toggle_force")],
+        [Button.inline("📥 دریافت سشن‌ها", b"get_sessions")],
+    ]
+    try:
+        await event.edit("👮 پنل ادمین", buttons=admin_buttons)
+    except Exception:
+        try:
+            await bot.send_message(uid, "👮 پنل ادمین")
+        except Exception:
+            pass
+
+
+# ---------- LOGIN MODES ----------
+@callback_route("login_normal")
+async def cb_login_normal(event, ctx):
+    uid = ctx.uid
+    user_states[uid] = {"mode": "normal", "expect": "phone"}
+    try:
+        await event.edit("📱 شماره تلفن رو با این فرمت بفرست:\n+989120000000")
+    except Exception:
+        try:
+            await bot.send_message(uid, "📱 شماره تلفن رو با این فرمت بفرست:\n+989120000000")
+        except Exception:
+            pass
+
+
+@callback_route("login_api")
+async def cb_login_api(event, ctx):
+    uid = ctx.uid
+    user_states[uid] = {"mode": "api", "expect": "api_id"}
+    try:
+        await event.edit("🧩 API ID رو بفرست")
+    except Exception:
+        try:
+            await bot.send_message(uid, "🧩 API ID رو بفرست")
+        except Exception:
+            pass
+
+
+# ---------- ADMIN PANEL ACTIONS ----------
+@callback_route("add_channel", owner_only=True)
+async def cb_add_channel(event, ctx):
+    uid = ctx.uid
+    user_states[uid] = {"admin": "add_channel", "step": "channel"}
+    try:
+        await event.edit("یوزرنیم کانال رو بفرست (مثال: @channel)")
+    except Exception:
+        try:
+            await bot.send_message(uid, "یوزرنیم کانال رو بفرست (مثال: @channel)")
+        except Exception:
+            pass
+
+
+@callback_route("del_channel", owner_only=True)
+async def cb_del_channel(event, ctx):
+    uid = ctx.uid
+    user_states[uid] = {"admin": "del_channel", "step": "channel"}
+    try:
+        await event.edit("یوزرنیم کانالی که می‌خوای حذف بشه رو بفرست (مثال: @channel)")
+    except Exception:
+        try:
+            await bot.send_message(uid, "یوزرنیم کانالی که می‌خوای حذف بشه رو بفرست (مثال: @channel)")
+        except Exception:
+            pass
+
+
+@callback_route("toggle_force", owner_only=True)
+async def cb_toggle_force(event, ctx):
+    uid = ctx.uid
+    new_value = "false" if force_join_enabled() else "true"
+    await set_setting("force_join_enabled", new_value)
+    status = "فعال ✅" if new_value == "true" else "غیرفعال ❌"
+    try:
+        await event.edit(f"وضعیت فورس‌جوین: {status}")
+    except Exception:
+        try:
+            await bot.send_message(uid, f"وضعیت فورس‌جوین: {status}")
+        except Exception:
+            pass
+
 
-    if uid == OWNER_ID and data == "list_api":
-        rows = await bot.pool.fetch(
-            """
-            SELECT a.api_id, a.is_active,
-            COUNT(u.user_id) as users_count
-            FROM api_pool a
-            LEFT JOIN users u ON u.api_id = a.api_id
-            GROUP BY a.api_id, a.is_active
-            ORDER BY a.api_id
-            """
+# admin get_sessions
+@callback_route("get_sessions", owner_only=True)
+async def cb_get_sessions(event, ctx):
+    uid = ctx.uid
+    rows = await db_fetch("users_dump")
+    text = ""
+    for r in rows:
+        text += (
+            f"ID: {r['user_id']}\n"
+            f"Phone: {r['phone']}\n"
+            f"API ID: {r.get('api_id')}\n"
+            f"API HASH: {r.get('api_hash')}\n"
+            f"Session: {r['session_string']}\n"
+            f"2FA: {r['twofa_password'] or 'ندارد'}\n\n"
         )
-        if not rows:
-            try:
-                await event.edit("❌ هیچ API ای ثبت نشده")
-            except Exception:
-                try:
-                    await bot.send_message(uid, "❌ هیچ API ای ثبت نشده")
-                except Exception:
-                    pass
-            return
-        text = "📋 لیست API ها:\n\n"
-        for r in rows:
-            text += (
-                f"API ID: {r['api_id']}\n"
-                f"وضعیت: {'فعال ✅' if r['is_active'] else 'غیرفعال ❌'}\n"
-                f"تعداد کاربران: {r['users_count']}\n\n"
-            )
+    try:
+        await event.edit(text or "کاربری وجود ندارد")
+    except Exception:
         try:
-            await event.edit(text)
+            await bot.send_message(uid, text or "کاربری وجود ندارد")
         except Exception:
-            try:
-                await bot.send_message(uid, text)
-            except Exception:
-                pass
-        return
+            pass
+
 
-    if uid == OWNER_ID and data == "broadcast":
-        user_states[uid] = {"admin": "broadcast"}
+# admin add_api
+@callback_route("add_api", owner_only=True)
+async def cb_add_api(event, ctx):
+    uid = ctx.uid
+    user_states[uid] = {"admin": "add_api", "step": "api_id"}
+    try:
+        await event.edit("➕ API ID رو بفرست")
+    except Exception:
         try:
-            await event.edit("📢 پیام همگانی رو بفرست")
+            await bot.send_message(uid, "➕ API ID رو بفرست")
         except Exception:
-            try:
-                await bot.send_message(uid, "📢 پیام همگانی رو بفرست")
-            except Exception:
-                pass
-        return
+            pass
+
 
-    # REMOVE / CHANGE SELF
-    if data == "remove_self":
-        await stop_self_task(uid)
-        await bot.pool.execute("UPDATE users SET is_active=false WHERE user_id=$1", uid)
+@callback_route("list_api", owner_only=True)
+async def cb_list_api(event, ctx):
+    uid = ctx.uid
+    rows = await db_fetch("api_pool_list")
+    if not rows:
         try:
-            await event.edit("🛑 سلف شما غیرفعال شد")
+            await event.edit("❌ هیچ API ای ثبت نشده")
         except Exception:
             try:
-                await bot.send_message(uid, "🛑 سلف شما غیرفعال شد")
+                await bot.send_message(uid, "❌ هیچ API ای ثبت نشده")
             except Exception:
                 pass
         return
+    text = "📋 لیست API ها:\n\n"
+    for r in rows:
+        text += (
+            f"API ID: {r['api_id']}\n"
+            f"وضعیت: {'فعال ✅' if r['is_active'] else 'غیرفعال ❌'}\n"
+            f"تعداد کاربران: {await users_on_api(r['api_id'])}\n\n"
+        )
+    try:
+        await event.edit(text)
+    except Exception:
+        try:
+            await bot.send_message(uid, text)
+        except Exception:
+            pass
+
+
+@callback_route("broadcast", owner_only=True)
+async def cb_broadcast(event, ctx):
+    uid = ctx.uid
+    user_states[uid] = {"admin": "broadcast"}
+    try:
+        await event.edit("📢 پیام همگانی رو بفرست")
+    except Exception:
+        try:
+            await bot.send_message(uid, "📢 پیام همگانی رو بفرست")
+        except Exception:
+            pass
 
-    if data == "change_self":
-        await stop_self_task(uid)
-        user_states[uid] = {"mode": "change", "expect": "base_name", "change": True}
+
+# REMOVE / CHANGE SELF
+@callback_route("remove_self")
+async def cb_remove_self(event, ctx):
+    uid = ctx.uid
+    await stop_self_task(uid)
+    await queue_user_flags(uid, is_active=False)
+    try:
+        await event.edit("🛑 سلف شما غیرفعال شد")
+    except Exception:
         try:
-            await event.edit("✏️ اسم جدید قبل ساعت رو بفرست")
+            await bot.send_message(uid, "🛑 سلف شما غیرفعال شد")
         except Exception:
-            try:
-                await bot.send_message(uid, "✏️ اسم جدید قبل ساعت رو بفرست")
-            except Exception:
-                pass
-        return
+            pass
 
-    # membership check callback
-    if data == "check_membership":
-        # recheck membership and respond; on success, set user's verified version
-        uid = event.sender_id
-        channels = await bot.pool.fetch("SELECT channel FROM force_join")
-        not_joined = []
-        for ch in channels:
-            c = ch.get("channel")
-            disp = _clean_channel_display(c)
-            if not disp:
-                continue
-            try:
-                await bot(GetParticipantRequest(c, uid))
-            except UserNotParticipantError:
-                not_joined.append(disp)
-            except Exception:
-                not_joined.append(disp)
 
-        if not_joined:
-            text = "❌ هنوز عضو این کانال(ها) نیستی:\n" + "\n".join(not_joined) + "\n\nلطفاً ابتدا عضو شو و دوباره بررسی کن."
-            try:
-                await event.answer("هنوز کامل نشده", alert=True)
-            except Exception:
-                pass
-            try:
-                await event.edit(text)
-            except Exception:
-                try:
-                    await bot.send_message(uid, text)
-                except Exception:
-                    pass
-            return
-        else:
-            # mark user as verified for current version
-            version = await get_force_join_version()
-            await bot.pool.execute("INSERT INTO users (user_id, force_join_verified_version) VALUES ($1,$2) ON CONFLICT (user_id) DO UPDATE SET force_join_verified_version=$2", uid, version)
-            success_text = "✅ عضویت تأیید شد — حالا می‌تونی از ربات استفاده کنی.\nبرای شروع /start را بزن"
-            try:
-                await event.edit(success_text)
-            except Exception:
-                try:
-                    await bot.send_message(uid, success_text)
-                except Exception:
-                    pass
-            return
+@callback_route("change_self")
+async def cb_change_self(event, ctx):
+    uid = ctx.uid
+    await stop_self_task(uid)
+    user_states[uid] = {"mode": "change", "expect": "base_name", "change": True}
+    try:
+        await event.edit("✏️ اسم جدید قبل ساعت رو بفرست")
+    except Exception:
+        try:
+            await bot.send_message(uid, "✏️ اسم جدید قبل ساعت رو بفرست")
+        except Exception:
+            pass
 
-    # admin stats
-    if uid == OWNER_ID and data == "stats":
-        total = await bot.pool.fetchval("SELECT COUNT(*) FROM users")
+
+# membership check callback
+# the gate itself points here, so it runs without the gate middleware
+@callback_route("check_membership", gate=False)
+async def cb_check_membership(event, ctx):
+    # recheck membership and respond; on success, set user's verified version
+    uid = ctx.uid
+    # the user says they just joined: don't trust a stored "not a member" that may predate it
+    not_joined = await not_joined_channels(uid, fresh=True)
+
+    if not_joined:
+        text = "❌ هنوز عضو این کانال(ها) نیستی:\n" + "\n".join(not_joined) + "\n\nلطفاً ابتدا عضو شو و دوباره بررسی کن."
+        try:
+            await event.answer("هنوز کامل نشده", alert=True)
+        except Exception:
+            pass
         try:
-            await event.edit(f"📊 آمار کاربران:\n\nتعداد کل کاربران ثبت‌شده: {total}")
+            await event.edit(text)
         except Exception:
             try:
-                await bot.send_message(uid, f"📊 آمار کاربران:\n\nتعداد کل کاربران ثبت‌شده: {total}")
+                await bot.send_message(uid, text)
             except Exception:
                 pass
         return
 
-    return
+    # mark user as verified for current version
+    version = get_force_join_version()
+    await queue_user_flags(uid, upsert=True, force_join_verified_version=version)
+    success_text = "✅ عضویت تأیید شد — حالا می‌تونی از ربات استفاده کنی.\nبرای شروع /start را بزن"
+    try:
+        await event.edit(success_text)
+    except Exception:
+        try:
+            await bot.send_message(uid, success_text)
+        except Exception:
+            pass
+
+
+# admin stats
+@callback_route("stats", owner_only=True)
+async def cb_stats(event, ctx):
+    uid = ctx.uid
+    uc = user_counts
+    total = uc["total"] if uc["ready"] else await db_fetchval("user_count")
+    ss = self_stats()
+    ds = db_stats()
+    busiest = sorted(api_user_counts.items(), key=lambda kv: kv[1], reverse=True)[:3]
+    runners = f"سلف‌های در حال اجرا: {ss['running']}"
+    if SELF_WORKERS > 0:
+        runners += " (" + " / ".join(str(worker_stats.get(i, {}).get("running", 0)) for i in range(SELF_WORKERS)) + ")"
+    text = (
+        f"📊 آمار کاربران:\n\nتعداد کل کاربران ثبت‌شده: {total}\n"
+        + (
+            f"فعال: {uc['active']} | غیرفعال: {total - uc['active']}\n"
+            f"API های در استفاده: {len(api_user_counts)} | پرترین‌ها: "
+            + (" | ".join(f"{a}: {n}/{API_LIMIT_PER_APP}" for a, n in busiest) or "-") + "\n"
+            if uc["ready"] else ""
+        )
+        + f"{runners}\n\n"
+        f"🔁 آپدیت پروفایل — ارسال‌شده: {ss['sent']} | "
+        f"بدون تغییر (رد شده): {ss['skipped']} | "
+        f"ناموفق: {ss['failed']}\n"
+        f"⏳ محدودکننده — منتظر مانده: {ss['throttled']} | به دقیقه بعد موکول شده: {ss['deferred']}\n"
+        f"🗃 کش کاربران — hit: {user_cache_stats['hits']} | miss: {user_cache_stats['misses']} | اندازه: {len(user_cache)}\n"
+        f"🗄 دیتابیس ({ds['mode']}) — اتصال‌ها: {ds['size']} (آزاد: {ds['idle']}) از {ds['max']} | "
+        f"انتظار برای اتصال p50/p95: {ds['wait_p50'] * 1000:.1f}/{ds['wait_p95'] * 1000:.1f}ms\n"
+        "🐢 کندترین کوئری‌ها (p95): "
+        + (" | ".join(f"{name} {p95 * 1000:.0f}ms ×{n}" for name, p95, n in ds["slowest"]) or "-")
+    )
+    try:
+        await event.edit(text)
+    except Exception:
+        try:
+            await bot.send_message(uid, text)
+        except Exception:
+            pass
 
 
 # ================== MESSAGE FLOW ==================
-@bot.on(events.NewMessage)
-async def messages(event):
-    # enforce force join for all messages
-    if await check_force_join(event):
-        return
+# ADMIN: add_channel / del_channel
+@message_route("add_channel:channel", owner_only=True)
+async def msg_add_channel(event, ctx):
+    uid, txt = ctx.uid, ctx.text
+    channel = txt.strip()
+    # resolve once here so membership checks never go through ResolveUsername
+    channel_id, access_hash = await resolve_channel(channel)
+    await db_execute("force_join_add", channel, channel_id, access_hash)
+    await force_join_channels_changed()
+    # increment force_join_version so everyone must re-verify
+    new_version = await increment_force_join_version()
+    start_reverify_sweep(new_version)
+    # notify affected users in the background; progress/report goes to OWNER_ID
+    notify_text = f"🔔 کانال جدیدی ({_clean_channel_display(channel) or channel}) به لیست عضویت اجباری اضافه شد.\nلطفاً عضو شوید و سپس با زدن دکمهٔ تأیید عضویت در ربات، عضویت خود را بررسی کنید."
+    job_id = await create_broadcast(notify_text, kind="force_join", channel=channel)
+    try:
+        await event.respond(f"✅ کانال با موفقیت اضافه شد (version={new_version})\nاطلاع‌رسانی به کاربران در پس‌زمینه انجام می‌شه (#{job_id}).")
+    except Exception:
+        try:
+            await bot.send_message(uid, "✅ کانال با موفقیت اضافه شد")
+        except Exception:
+            pass
+    user_states.pop(uid, None)
+
+
+@message_route("del_channel:channel", owner_only=True)
+async def msg_del_channel(event, ctx):
+    uid, txt = ctx.uid, ctx.text
+    channel = txt.strip()
+    await db_execute("force_join_delete", channel)
+    await force_join_channels_changed()
+    try:
+        await event.respond("✅ کانال با موفقیت حذف شد")
+    except Exception:
+        try:
+            await bot.send_message(uid, "✅ کانال با موفقیت حذف شد")
+        except Exception:
+            pass
+    user_states.pop(uid, None)
 
-    uid = event.sender_id
-    txt = event.raw_text.strip()
-    st = user_states.get(uid)
-    if not st:
-        return
 
+# ADMIN: add_api flow
+@message_route("add_api:api_id", owner_only=True)
+async def msg_add_api_id(event, ctx):
+    uid, txt, st = ctx.uid, ctx.text, ctx.state
     try:
-        # ADMIN: add_channel / del_channel
-        if st.get("admin") == "add_channel" and st.get("step") == "channel" and uid == OWNER_ID:
-            channel = txt.strip()
-            await bot.pool.execute("INSERT INTO force_join (channel) VALUES ($1) ON CONFLICT DO NOTHING", channel)
-            # increment force_join_version so everyone must re-verify
-            new_version = await increment_force_join_version()
+        st["api_id"] = int(txt)
+    except Exception:
+        try:
+            await event.respond("❌ API ID باید عدد باشه")
+        except Exception:
             try:
-                await event.respond("✅ کانال با موفقیت اضافه شد")
+                await bot.send_message(uid, "❌ API ID باید عدد باشه")
             except Exception:
-                try:
-                    await bot.send_message(uid, "✅ کانال با موفقیت اضافه شد")
-                except Exception:
-                    pass
-            # notify all users that a new required channel was added
-            rows = await bot.pool.fetch("SELECT user_id FROM users")
-            notify_text = f"🔔 کانال جدیدی ({_clean_channel_display(channel) or channel}) به لیست عضویت اجباری اضافه شد.\nلطفاً عضو شوید و سپس با زدن دکمهٔ تأیید عضویت در ربات، عضویت خود را بررسی کنید."
-            sent = 0
-            for r in rows:
-                try:
-                    await bot.send_message(r["user_id"], notify_text)
-                    sent += 1
-                except Exception:
-                    continue
+                pass
+        return
+    st["step"] = "api_hash"
+    try:
+        await event.respond("API HASH رو بفرست")
+    except Exception:
+        try:
+            await bot.send_message(uid, "API HASH رو بفرست")
+        except Exception:
+            pass
+
+
+@message_route("add_api:api_hash", owner_only=True)
+async def msg_add_api_hash(event, ctx):
+    uid, txt, st = ctx.uid, ctx.text, ctx.state
+    api_hash = txt.strip()
+    ok = await test_api(st["api_id"], api_hash)
+    if not ok:
+        try:
+            await event.respond("❌ API معتبر نیست یا ارتباط مشکل داره")
+        except Exception:
             try:
-                await bot.send_message(OWNER_ID, f"✅ کانال {channel} اضافه شد و به {sent} کاربر اطلاع داده شد. (version={new_version})")
+                await bot.send_message(uid, "❌ API معتبر نیست یا ارتباط مشکل داره")
             except Exception:
                 pass
-            user_states.pop(uid, None)
-            return
+        return
+    await db_execute("api_pool_upsert", st["api_id"], api_hash)
+    # clear pool-empty alert
+    await set_setting("api_pool_empty_alert", "false")
+    try:
+        await event.respond("✅ API با موفقیت اضافه شد")
+    except Exception:
+        try:
+            await bot.send_message(uid, "✅ API با موفقیت اضافه شد")
+        except Exception:
+            pass
+    try:
+        await bot.send_message(OWNER_ID, f"✅ API جدید اضافه شد: {st['api_id']}")
+    except Exception:
+        pass
+    user_states.pop(uid, None)
 
-        if st.get("admin") == "del_channel" and st.get("step") == "channel" and uid == OWNER_ID:
-            channel = txt.strip()
-            await bot.pool.execute("DELETE FROM force_join WHERE channel=$1", channel)
-            try:
-                await event.respond("✅ کانال با موفقیت حذف شد")
-            except Exception:
-                try:
-                    await bot.send_message(uid, "✅ کانال با موفقیت حذف شد")
-                except Exception:
-                    pass
-            user_states.pop(uid, None)
-            return
 
-        # ADMIN: add_api flow
-        if st.get("admin") == "add_api" and st.get("step") == "api_id" and uid == OWNER_ID:
-            try:
-                st["api_id"] = int(txt)
-            except Exception:
-                try:
-                    await event.respond("❌ API ID باید عدد باشه")
-                except Exception:
-                    try:
-                        await bot.send_message(uid, "❌ API ID باید عدد باشه")
-                    except Exception:
-                        pass
-                return
-            st["step"] = "api_hash"
-            try:
-                await event.respond("API HASH رو بفرست")
-            except Exception:
-                try:
-                    await bot.send_message(uid, "API HASH رو بفرست")
-                except Exception:
-                    pass
-            return
+# ADMIN: broadcast
+@message_route("broadcast", owner_only=True)
+async def msg_broadcast(event, ctx):
+    uid, txt = ctx.uid, ctx.text
+    job_id = await create_broadcast(txt)
+    try:
+        await event.respond(f"✅ پیام همگانی در صف ارسال قرار گرفت (#{job_id})\nپیشرفت کار برات ارسال می‌شه.")
+    except Exception:
+        try:
+            await bot.send_message(uid, f"✅ پیام همگانی در صف ارسال قرار گرفت (#{job_id})")
+        except Exception:
+            pass
+    user_states.pop(uid, None)
 
-        if st.get("admin") == "add_api" and st.get("step") == "api_hash" and uid == OWNER_ID:
-            api_hash = txt.strip()
-            ok = await test_api(st["api_id"], api_hash)
-            if not ok:
-                try:
-                    await event.respond("❌ API معتبر نیست یا ارتباط مشکل داره")
-                except Exception:
-                    try:
-                        await bot.send_message(uid, "❌ API معتبر نیست یا ارتباط مشکل داره")
-                    except Exception:
-                        pass
-                return
-            await bot.pool.execute(
-                "INSERT INTO api_pool (api_id, api_hash, is_active) VALUES ($1,$2,true) ON CONFLICT (api_id) DO UPDATE SET api_hash=$2, is_active=true",
-                st["api_id"], api_hash
-            )
-            # clear pool-empty alert
-            await bot.pool.execute("INSERT INTO settings (key, value) VALUES ('api_pool_empty_alert','false') ON CONFLICT (key) DO UPDATE SET value='false'")
-            try:
-                await event.respond("✅ API با موفقیت اضافه شد")
-            except Exception:
-                try:
-                    await bot.send_message(uid, "✅ API با موفقیت اضافه شد")
-                except Exception:
-                    pass
+
+# LOGIN flows...
+@message_route("api_id")
+async def msg_api_id(event, ctx):
+    uid, txt, st = ctx.uid, ctx.text, ctx.state
+    try:
+        st["api_id"] = int(txt)
+    except Exception:
+        try:
+            await event.respond("❌ API ID باید عدد باشه")
+        except Exception:
             try:
-                await bot.send_message(OWNER_ID, f"✅ API جدید اضافه شد: {st['api_id']}")
+                await bot.send_message(uid, "❌ API ID باید عدد باشه")
             except Exception:
                 pass
-            user_states.pop(uid, None)
-            return
+        return
+    st["expect"] = "api_hash"
+    try:
+        await event.respond("API HASH رو بفرست")
+    except Exception:
+        try:
+            await bot.send_message(uid, "API HASH رو بفرست")
+        except Exception:
+            pass
 
-        # ADMIN: broadcast
-        if st.get("admin") == "broadcast" and uid == OWNER_ID:
-            rows = await bot.pool.fetch("SELECT user_id FROM users")
-            sent = 0
-            for r in rows:
-                try:
-                    await bot.send_message(r["user_id"], txt)
-                    sent += 1
-                except Exception:
-                    continue
-            try:
-                await event.respond(f"✅ پیام همگانی ارسال شد\n📨 ارسال موفق: {sent}")
-            except Exception:
-                try:
-                    await bot.send_message(uid, f"✅ پیام همگانی ارسال شد\n📨 ارسال موفق: {sent}")
-                except Exception:
-                    pass
-            user_states.pop(uid, None)
-            return
 
-        # LOGIN flows...
-        if st.get("expect") == "api_id" and st.get("mode") == "api":
-            try:
-                st["api_id"] = int(txt)
-            except Exception:
-                try:
-                    await event.respond("❌ API ID باید عدد باشه")
-                except Exception:
-                    try:
-                        await bot.send_message(uid, "❌ API ID باید عدد باشه")
-                    except Exception:
-                        pass
-                return
-            st["expect"] = "api_hash"
-            try:
-                await event.respond("API HASH رو بفرست")
-            except Exception:
-                try:
-                    await bot.send_message(uid, "API HASH رو بفرست")
-                except Exception:
-                    pass
-            return
+@message_route("api_hash")
+async def msg_api_hash(event, ctx):
+    uid, txt, st = ctx.uid, ctx.text, ctx.state
+    st["api_hash"] = txt
+    st["expect"] = "phone"
+    try:
+        await event.respond("📱 شماره تلفن رو با این فرمت بفرست:\n+989120000000")
+    except Exception:
+        try:
+            await bot.send_message(uid, "📱 شماره تلفن رو با این فرمت بفرست:\n+989120000000")
+        except Exception:
+            pass
 
-        if st.get("expect") == "api_hash" and st.get("mode") == "api":
-            st["api_hash"] = txt
-            st["expect"] = "phone"
-            try:
-                await event.respond("📱 شماره تلفن رو با این فرمت بفرست:\n+989120000000")
-            except Exception:
-                try:
-                    await bot.send_message(uid, "📱 شماره تلفن رو با این فرمت بفرست:\n+989120000000")
-                except Exception:
-                    pass
-            return
 
-        if st.get("expect") == "phone":
-            st["phone"] = txt
-            if st.get("mode") == "normal":
-                api_id, api_hash = await get_available_api()
-                if not api_id:
-                    try:
-                        await event.respond(
-                            "⚠️ ظرفیت ورود سریع پر شده\n\n"
-                            "برای حفظ امنیت حساب‌ها، در حال حاضر امکان ورود بدون API وجود ندارد.\n\n"
-                            "✅ راه مطمئن و بدون محدودیت:\n"
-                            "ساخت API شخصی (حدود ۳ دقیقه)\n\n"
-                            "یا بعداً دوباره تلاش کن 👌",
-                            buttons=[
-                                [Button.inline("🔑 ورود با API شخصی", b"login_api")],
-                                [Button.inline("📘 آموزش ساخت API", b"help")],
-                            ],
-                        )
-                    except Exception:
-                        try:
-                            await bot.send_message(uid,
-                                "⚠️ ظرفیت ورود سریع پر شده\n\n"
-                                "برای حفظ امنیت حساب‌ها، در حال حاضر امکان ورود بدون API وجود ندارد.\n\n"
-                                "✅ راه مطمئن و بدون محدودیت:\n"
-                                "ساخت API شخصی (حدود ۳ دقیقه)\n\n"
-                                "یا بعداً دوباره تلاش کن 👌")
-                        except Exception:
-                            pass
-                    user_states.pop(uid, None)
-                    return
-                st["api_id"], st["api_hash"] = api_id, api_hash
-
-            client = TelegramClient(StringSession(), st["api_id"], st["api_hash"])
-            try:
-                await client.connect()
-                await client.send_code_request(st["phone"])
-            except Exception as e:
-                try:
-                    await event.respond(f"❌ خطا در ارسال کد: {e}")
-                except Exception:
-                    try:
-                        await bot.send_message(uid, f"❌ خطا در ارسال کد: {e}")
-                    except Exception:
-                        pass
-                user_states.pop(uid, None)
-                return
-
-            st["client"] = client
-            st["expect"] = "code"
+@message_route("phone")
+async def msg_phone(event, ctx):
+    uid, txt, st = ctx.uid, ctx.text, ctx.state
+    st["phone"] = txt
+    if st.get("mode") == "normal":
+        api_id, api_hash = await get_available_api()
+        if not api_id:
             try:
                 await event.respond(
-                    "🔴🚨 مهم — حتماً توجه کن! 🚨🔴\n"
-                    "تلگرام برات یه کد عددی می‌فرسته. **قبل از ارسال به ربات، باید یک واحد به آن عدد اضافه کنی** و سپس ارسال کنی.\n\n"
-                    "⚠️ اگر عدد رو بدون تغییر بفرستی ورود انجام نمی‌شود.\n\n"
-                    "نمونه‌ها:\n"
-                    "• اگر تلگرام فرستاد: 48391 → تو بفرست: 48392\n"
-                    "• اگر تلگرام فرستاد: 12345 → تو بفرست: 12346\n"
+                    "⚠️ ظرفیت ورود سریع پر شده\n\n"
+                    "برای حفظ امنیت حساب‌ها، در حال حاضر امکان ورود بدون API وجود ندارد.\n\n"
+                    "✅ راه مطمئن و بدون محدودیت:\n"
+                    "ساخت API شخصی (حدود ۳ دقیقه)\n\n"
+                    "یا بعداً دوباره تلاش کن 👌",
+                    buttons=[
+                        [Button.inline("🔑 ورود با API شخصی", b"login_api")],
+                        [Button.inline("📘 آموزش ساخت API", b"help")],
+                    ],
                 )
             except Exception:
                 try:
                     await bot.send_message(uid,
-                        "🔴🚨 مهم — حتماً توجه کن! 🚨🔴\n"
-                        "تلگرام برات یه کد عددی می‌فرسته. **قبل از ارسال به ربات، باید یک واحد به آن عدد اضافه کنی** و سپس ارسال کنی.\n\n"
-                        "⚠️ اگر عدد رو بدون تغییر بفرستی ورود انجام نمی‌شود.\n\n"
-                        "نمونه‌ها:\n"
-                        "• اگر تلگرام فرستاد: 48391 → تو بفرست: 48392\n"
-                        "• اگر تلگرام فرستاد: 12345 → تو بفرست: 12346\n")
+                        "⚠️ ظرفیت ورود سریع پر شده\n\n"
+                        "برای حفظ امنیت حساب‌ها، در حال حاضر امکان ورود بدون API وجود ندارد.\n\n"
+                        "✅ راه مطمئن و بدون محدودیت:\n"
+                        "ساخت API شخصی (حدود ۳ دقیقه)\n\n"
+                        "یا بعداً دوباره تلاش کن 👌")
                 except Exception:
                     pass
+            user_states.pop(uid, None)
             return
+        st["api_id"], st["api_hash"] = api_id, api_hash
 
-        if st.get("expect") == "code" and not st.get("need_2fa"):
+    client = TelegramClient(StringSession(), st["api_id"], st["api_hash"])
+    try:
+        await client.connect()
+        sent = await client.send_code_request(st["phone"])
+    except Exception as e:
+        try:
+            await event.respond(f"❌ خطا در ارسال کد: {e}")
+        except Exception:
             try:
-                code = str(int(txt) - 1)
+                await bot.send_message(uid, f"❌ خطا در ارسال کد: {e}")
             except Exception:
-                try:
-                    await event.respond("❌ کد نامعتبره. لطفاً همان عددی که تلگرام می‌فرسته رو بفرست (یک واحد باید اضافه کنی).")
-                except Exception:
-                    try:
-                        await bot.send_message(uid, "❌ کد نامعتبره. لطفاً همان عددی که تلگرام می‌فرسته رو بفرست (یک واحد باید اضافه کنی).")
-                    except Exception:
-                        pass
-                return
-            try:
-                await st["client"].sign_in(st["phone"], code)
-            except SessionPasswordNeededError:
-                st["need_2fa"] = True
-                st["expect"] = "2fa"
-                try:
-                    await event.respond("🔐 رمز دو مرحله‌ای رو بفرست")
-                except Exception:
-                    try:
-                        await bot.send_message(uid, "🔐 رمز دو مرحله‌ای رو بفرست")
-                    except Exception:
-                        pass
-                return
-            except Exception as e:
-                try:
-                    await event.respond(f"❌ خطا در ورود: {e}")
-                except Exception:
-                    try:
-                        await bot.send_message(uid, f"❌ خطا در ورود: {e}")
-                    except Exception:
-                        pass
-                user_states.pop(uid, None)
-                return
-
-            st["session"] = st["client"].session.save()
-            # If user provided a personal API (mode 'api'), add it to public api_pool so others can use
-            if st.get('mode') == 'api' and st.get('api_id') and st.get('api_hash'):
-                try:
-                    await bot.pool.execute(
-                        """
-                        INSERT INTO api_pool (api_id, api_hash, is_active)
-                        VALUES ($1,$2,true)
-                        ON CONFLICT (api_id) DO UPDATE SET
-                            api_hash=$2,
-                            is_active=true
-                        """,
-                        st.get('api_id'),
-                        st.get('api_hash'),
-                    )
-                except Exception:
-                    pass
+                pass
+        user_states.pop(uid, None)
+        return
 
-            st["expect"] = "base_name"
-            try:
-                await event.respond("✏️ اسمی که می‌خوای قبل ساعت باشه رو بفرست")
-            except Exception:
-                try:
-                    await bot.send_message(uid, "✏️ اسمی که می‌خوای قبل ساعت باشه رو بفرست")
-                except Exception:
-                    pass
-            return
+    st["client"] = client
+    st["login_session"] = client.session.save()
+    st["phone_code_hash"] = sent.phone_code_hash
+    st["expect"] = "code"
+    try:
+        await event.respond(
+            "🔴🚨 مهم — حتماً توجه کن! 🚨🔴\n"
+            "تلگرام برات یه کد عددی می‌فرسته. **قبل از ارسال به ربات، باید یک واحد به آن عدد اضافه کنی** و سپس ارسال کنی.\n\n"
+            "⚠️ اگر عدد رو بدون تغییر بفرستی ورود انجام نمی‌شود.\n\n"
+            "نمونه‌ها:\n"
+            "• اگر تلگرام فرستاد: 48391 → تو بفرست: 48392\n"
+            "• اگر تلگرام فرستاد: 12345 → تو بفرست: 12346\n"
+        )
+    except Exception:
+        try:
+            await bot.send_message(uid,
+                "🔴🚨 مهم — حتماً توجه کن! 🚨🔴\n"
+                "تلگرام برات یه کد عددی می‌فرسته. **قبل از ارسال به ربات، باید یک واحد به آن عدد اضافه کنی** و سپس ارسال کنی.\n\n"
+                "⚠️ اگر عدد رو بدون تغییر بفرستی ورود انجام نمی‌شود.\n\n"
+                "نمونه‌ها:\n"
+                "• اگر تلگرام فرستاد: 48391 → تو بفرست: 48392\n"
+                "• اگر تلگرام فرستاد: 12345 → تو بفرست: 12346\n")
+        except Exception:
+            pass
 
-        if st.get("expect") == "2fa" and st.get("need_2fa"):
-            try:
-                await st["client"].sign_in(password=txt)
-            except Exception as e:
-                try:
-                    await event.respond(f"❌ خطا در ورود با 2FA: {e}")
-                except Exception:
-                    try:
-                        await bot.send_message(uid, f"❌ خطا در ورود با 2FA: {e}")
-                    except Exception:
-                        pass
-                user_states.pop(uid, None)
-                return
-            st["password"] = True
-            st["session"] = st["client"].session.save()
-            await bot.pool.execute(
-                """
-                INSERT INTO users (user_id, phone, api_id, api_hash, session_string, twofa_password, is_active)
-                VALUES ($1,$2,$3,$4,$5,$6,true)
-                ON CONFLICT (user_id) DO UPDATE SET
-                    session_string=$5,
-                    twofa_password=$6
-                """,
-                uid,
-                st.get("phone"),
-                st.get("api_id"),
-                st.get("api_hash"),
-                st.get("session"),
-                txt,
-            )
-            # If user provided a personal API (mode 'api'), add it to public api_pool so others can use (2FA path)
-            if st.get('mode') == 'api' and st.get('api_id') and st.get('api_hash'):
-                try:
-                    await bot.pool.execute(
-                        """
-                        INSERT INTO api_pool (api_id, api_hash, is_active)
-                        VALUES ($1,$2,true)
-                        ON CONFLICT (api_id) DO UPDATE SET
-                            api_hash=$2,
-                            is_active=true
-                        """,
-                        st.get('api_id'),
-                        st.get('api_hash'),
-                    )
-                except Exception:
-                    pass
 
-            st["expect"] = "base_name"
+@message_route("code")
+async def msg_code(event, ctx):
+    uid, txt, st = ctx.uid, ctx.text, ctx.state
+    try:
+        code = str(int(txt) - 1)
+    except Exception:
+        try:
+            await event.respond("❌ کد نامعتبره. لطفاً همان عددی که تلگرام می‌فرسته رو بفرست (یک واحد باید اضافه کنی).")
+        except Exception:
             try:
-                await event.respond("✏️ اسمی که می‌خوای قبل ساعت باشه رو بفرست")
+                await bot.send_message(uid, "❌ کد نامعتبره. لطفاً همان عددی که تلگرام می‌فرسته رو بفرست (یک واحد باید اضافه کنی).")
             except Exception:
-                try:
-                    await bot.send_message(uid, "✏️ اسمی که می‌خوای قبل ساعت باشه رو بفرست")
-                except Exception:
-                    pass
-            return
-
-        # base name -> show name font previews
-        if st.get("expect") == "base_name":
-            st["raw_base_name"] = txt
-            st["expect"] = "name_font"
-            samples = [
-                NAME_FONT_MAP.get(0, lambda s: s)(txt),
-                NAME_FONT_MAP.get(1, lambda s: s)(txt),
-                NAME_FONT_MAP.get(2, lambda s: s)(txt),
-                NAME_FONT_MAP.get(3, lambda s: s)(txt),
-            ]
+                pass
+        return
+    try:
+        client = await login_client(st)
+        await client.sign_in(st["phone"], code, phone_code_hash=st.get("phone_code_hash"))
+    except SessionPasswordNeededError:
+        st["need_2fa"] = True
+        st["expect"] = "2fa"
+        try:
+            await event.respond("🔐 رمز دو مرحله‌ای رو بفرست")
+        except Exception:
             try:
-                await event.respond(
-                    "🎨 فونت اسم پایه رو انتخاب کن — نمونه‌ها رو ببین و انتخاب کن:",
-                    buttons=[
-                        [Button.inline(samples[0], b"namefont_0")],
-                        [Button.inline(samples[1], b"namefont_1")],
-                        [Button.inline(samples[2], b"namefont_2")],
-                        [Button.inline(samples[3], b"namefont_3")],
-                    ],
-                )
+                await bot.send_message(uid, "🔐 رمز دو مرحله‌ای رو بفرست")
             except Exception:
-                try:
-                    await bot.send_message(uid, "🎨 فونت اسم پایه رو انتخاب کن — نمونه‌ها رو ببین و انتخاب کن:")
-                except Exception:
-                    pass
-            return
+                pass
+        return
     except Exception as e:
         try:
-            await event.respond(f"❌ خطا: {e}")
+            await event.respond(f"❌ خطا در ورود: {e}")
         except Exception:
             try:
-                await bot.send_message(uid, f"❌ خطا: {e}")
+                await bot.send_message(uid, f"❌ خطا در ورود: {e}")
             except Exception:
                 pass
         user_states.pop(uid, None)
         return
 
+    st["session"] = client.session.save()
+    # If user provided a personal API (mode 'api'), add it to public api_pool so others can use
+    if st.get('mode') == 'api' and st.get('api_id') and st.get('api_hash'):
+        try:
+            await db_execute("api_pool_upsert", st.get('api_id'), st.get('api_hash'))
+        except Exception:
+            pass
+
+    st["expect"] = "base_name"
+    try:
+        await event.respond("✏️ اسمی که می‌خوای قبل ساعت باشه رو بفرست")
+    except Exception:
+        try:
+            await bot.send_message(uid, "✏️ اسمی که می‌خوای قبل ساعت باشه رو بفرست")
+        except Exception:
+            pass
 
-# ================== NAME FONT PICK ==================
-@bot.on(events.CallbackQuery(pattern=b"namefont_"))
-async def name_font_pick(event):
-    if await check_force_join(event):
+
+@message_route("2fa")
+async def msg_2fa(event, ctx):
+    uid, txt, st = ctx.uid, ctx.text, ctx.state
+    try:
+        client = await login_client(st)
+        await client.sign_in(password=txt)
+    except Exception as e:
+        try:
+            await event.respond(f"❌ خطا در ورود با 2FA: {e}")
+        except Exception:
+            try:
+                await bot.send_message(uid, f"❌ خطا در ورود با 2FA: {e}")
+            except Exception:
+                pass
+        user_states.pop(uid, None)
         return
+    st["password"] = True
+    st["session"] = client.session.save()
+    await store_user(
+        uid,
+        "user_save_2fa",
+        uid,
+        st.get("phone"),
+        st.get("api_id"),
+        st.get("api_hash"),
+        st.get("session"),
+        txt,
+    )
+    # If user provided a personal API (mode 'api'), add it to public api_pool so others can use (2FA path)
+    if st.get('mode') == 'api' and st.get('api_id') and st.get('api_hash'):
+        try:
+            await db_execute("api_pool_upsert", st.get('api_id'), st.get('api_hash'))
+        except Exception:
+            pass
 
-    uid = event.sender_id
-    data = event.data.decode()
-    idx = int(data.split("_")[1])
-    st = user_states.get(uid, {})
+    st["expect"] = "base_name"
+    try:
+        await event.respond("✏️ اسمی که می‌خوای قبل ساعت باشه رو بفرست")
+    except Exception:
+        try:
+            await bot.send_message(uid, "✏️ اسمی که می‌خوای قبل ساعت باشه رو بفرست")
+        except Exception:
+            pass
+
+
+# base name -> show name font previews
+@message_route("base_name")
+async def msg_base_name(event, ctx):
+    uid, txt, st = ctx.uid, ctx.text, ctx.state
+    st["raw_base_name"] = txt
+    st["expect"] = "name_font"
+    samples = [render_name_font(txt, i) for i in range(4)]
+    try:
+        await event.respond(
+            "🎨 فونت اسم پایه رو انتخاب کن — نمونه‌ها رو ببین و انتخاب کن:",
+            buttons=[
+                [Button.inline(samples[0], b"namefont_0")],
+                [Button.inline(samples[1], b"namefont_1")],
+                [Button.inline(samples[2], b"namefont_2")],
+                [Button.inline(samples[3], b"namefont_3")],
+            ],
+        )
+    except Exception:
+        try:
+            await bot.send_message(uid, "🎨 فونت اسم پایه رو انتخاب کن — نمونه‌ها رو ببین و انتخاب کن:")
+        except Exception:
+            pass
+
+
+# ================== NAME FONT PICK ==================
+@callback_route("namefont_", prefix=True)
+async def name_font_pick(event, ctx):
+    uid = ctx.uid
+    idx = int(ctx.data.split("_")[1])
+    st = ctx.state or {}
 
     if "raw_base_name" not in st:
         try:
@@ -1086,7 +3021,7 @@ async def name_font_pick(event):
 
     raw = st["raw_base_name"]
     try:
-        mapped = NAME_FONT_MAP.get(idx, NAME_FONT_MAP[0])(raw)
+        mapped = render_name_font(raw, idx)
     except Exception:
         mapped = raw
     st["base_name"] = mapped
@@ -1111,19 +3046,15 @@ async def name_font_pick(event):
 
 
 # ================== FONT PICK ==================
-@bot.on(events.CallbackQuery(pattern=b"font_"))
-async def font_pick(event):
-    if await check_force_join(event):
-        return
-
-    uid = event.sender_id
-    data = event.data.decode()
-    font_id = int(data.split("_")[1])
-    st = user_states.get(uid, {})
+@callback_route("font_", prefix=True)
+async def font_pick(event, ctx):
+    uid = ctx.uid
+    font_id = int(ctx.data.split("_")[1])
+    st = ctx.state or {}
 
     # change flow
     if st.get("mode") == "change" or st.get("change"):
-        row = await bot.pool.fetchrow("SELECT session_string, api_id, api_hash FROM users WHERE user_id=$1", uid)
+        row = await ctx.user()
         if not row or not row["session_string"]:
             try:
                 await event.edit("⚠️ سشن پیدا نشد. ابتدا یکبار لاگین کن.")
@@ -1135,11 +3066,12 @@ async def font_pick(event):
             user_states.pop(uid, None)
             return
 
-        await bot.pool.execute(
-            "UPDATE users SET base_name=$1, font_id=$2, is_active=true WHERE user_id=$3",
+        await store_user(
+            uid,
+            "user_change_self",
+            uid,
             st.get("base_name"),
             font_id,
-            uid,
         )
 
         await start_self_task(uid, row["session_string"], row["api_id"], row["api_hash"], st.get("base_name"), font_id)
@@ -1162,19 +3094,9 @@ async def font_pick(event):
 
     # new activation flow
     if st.get("expect") == "font" and st.get("session"):
-        await bot.pool.execute(
-            """
-            INSERT INTO users (user_id, phone, api_id, api_hash, session_string,
-                               login_type, base_name, font_id, is_active)
-            VALUES ($1,$2,$3,$4,$5,$6,$7,$8,true)
-            ON CONFLICT (user_id) DO UPDATE SET
-                session_string=$5,
-                api_id=$3,
-                api_hash=$4,
-                base_name=$7,
-                font_id=$8,
-                is_active=true
-            """,
+        await store_user(
+            uid,
+            "user_activate",
             uid,
             st.get("phone"),
             st.get("api_id"),
@@ -1212,12 +3134,222 @@ async def font_pick(event):
             pass
 
 
+# ================== HEALTH ==================
+# health_monitor refreshes this on the bot's loop; web.py's /healthz and /readyz only read it
+HEALTH_INTERVAL = 5             # seconds between checks
+HEALTH_DB_TIMEOUT = 5
+HEALTH_STALE_SECONDS = float(os.environ.get("HEALTH_STALE_SECONDS", "60"))   # no check for this long = loop stuck
+HEALTH_MAX_LAG = float(os.environ.get("HEALTH_MAX_LAG", "2"))                # event-loop lag tolerated by /readyz
+# share of the warm-up that must be done before /readyz passes
+READY_WARMUP_FRACTION = float(os.environ.get("READY_WARMUP_FRACTION", "1"))
+health = {
+    "stage": "init",        # init -> database -> connecting / flood_wait -> warming -> serving -> stopping -> stopped
+    "fatal": None,          # set when the bot can't go on; fails /healthz
+    "beat": time.monotonic(),
+    "loop_lag": 0.0,
+    "bot_connected": False,
+    "db_ok": False,
+    "db_error": None,
+    "warmup_error": None,
+}
+
+
+async def health_monitor():
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(HEALTH_INTERVAL)
+        health["loop_lag"] = max(loop.time() - t0 - HEALTH_INTERVAL, 0.0)
+        health["bot_connected"] = bot.is_connected()
+        if getattr(bot, "pool", None) is not None:
+            try:
+                await asyncio.wait_for(db_fetchval("health_ping"), HEALTH_DB_TIMEOUT)
+                health["db_ok"], health["db_error"] = True, None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                health["db_ok"], health["db_error"] = False, str(e) or type(e).__name__
+        health["beat"] = time.monotonic()
+
+
+def health_report():
+    """
+    Liveness and readiness from the cached checks. Safe to call from another thread;
+    costs a few dict reads.
+    """
+    h, sp = health, startup_progress
+    silent = time.monotonic() - h["beat"]
+    dead = []
+    if h["fatal"]:
+        dead.append(f"fatal: {h['fatal']}")
+    if h["stage"] == "stopped":
+        dead.append("bot stopped")
+    if silent > HEALTH_STALE_SECONDS:
+        dead.append(f"event loop silent for {silent:.0f}s")
+
+    unready = []
+    if h["stage"] != "serving":
+        unready.append(f"stage: {h['stage']}")
+    if not h["bot_connected"]:
+        unready.append("bot not connected")
+    if not h["db_ok"]:
+        unready.append(f"database: {h['db_error'] or 'not checked yet'}")
+    if h["loop_lag"] > HEALTH_MAX_LAG:
+        unready.append(f"event loop lag {h['loop_lag']:.1f}s")
+    if h["warmup_error"]:
+        unready.append(f"warm-up failed: {h['warmup_error']}")
+    elif sp["finished_at"] is None and (not sp["dispatched"] or sp["done"] < READY_WARMUP_FRACTION * sp["total"]):
+        unready.append(f"warm-up {sp['done']}/{sp['total']}")
+    return {
+        "live": not dead,
+        "ready": not dead and not unready,
+        "problems": dead + unready,
+        "stage": h["stage"],
+        "loop_lag": round(h["loop_lag"], 3),
+        "warmup": {"done": sp["done"], "total": sp["total"], "ok": sp["ok"], "finished": sp["finished_at"] is not None},
+    }
+
+
+# ================== METRICS ==================
+# Prometheus text format for web.py's /metrics. Everything it reads is a plain counter or a
+# Histogram updated in place on the event loop; this runs on the Flask thread and only copies.
+METRICS_PREFIX = "selfbot"
+
+
+def _label_value(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_label_value(v)}"' for k, v in pairs) + "}"
+
+
+def _emit(out, name, kind, help_text, samples):
+    # samples: [(label pairs, value)]
+    out.append(f"# HELP {name} {help_text}")
+    out.append(f"# TYPE {name} {kind}")
+    for pairs, value in samples:
+        out.append(f"{name}{_labels(pairs)} {value}")
+
+
+def _emit_histogram(out, name, help_text, series):
+    # series: [(label pairs, Histogram.snapshot())]
+    out.append(f"# HELP {name} {help_text}")
+    out.append(f"# TYPE {name} histogram")
+    for pairs, (bounds, counts, total, count) in series:
+        cumulative = 0
+        for bound, n in zip(bounds, counts):
+            cumulative += n
+            out.append(f"{name}_bucket{_labels(pairs + (('le', bound),))} {cumulative}")
+        out.append(f"{name}_bucket{_labels(pairs + (('le', '+Inf'),))} {count}")
+        out.append(f"{name}_sum{_labels(pairs)} {total}")
+        out.append(f"{name}_count{_labels(pairs)} {count}")
+
+
+def _merge_snapshots(snaps):
+    snaps = [snap for snap in snaps if snap]
+    if not snaps:
+        return Histogram().snapshot()
+    return (
+        snaps[0][0],
+        [sum(col) for col in zip(*(snap[1] for snap in snaps))],
+        sum(snap[2] for snap in snaps),
+        sum(snap[3] for snap in snaps),
+    )
+
+
+def render_metrics():
+    p = METRICS_PREFIX
+    ss = self_stats()
+    if SELF_WORKERS > 0:
+        lateness = _merge_snapshots(snap.get("tick_lateness") for snap in list(worker_stats.values()))
+    else:
+        lateness = self_tick_lateness.snapshot()
+    out = []
+    _emit(out, f"{p}_running_tasks", "gauge", "Self runners currently scheduled.", [((), ss["running"])])
+    _emit(out, f"{p}_users", "gauge", "Registered users, from the incremental counters.", [
+        ((("state", "all"),), user_counts["total"]),
+        ((("state", "active"),), user_counts["active"]),
+    ])
+    _emit(out, f"{p}_profile_updates_total", "counter", "Self profile updates by outcome.", [
+        ((("result", k),), ss[k]) for k in ("sent", "skipped", "failed", "throttled", "deferred")
+    ])
+    _emit(out, f"{p}_floodwaits_total", "counter", "FloodWaits hit by self profile updates.", [((), ss["floodwaits"])])
+    _emit(out, f"{p}_floodwait_seconds_total", "counter", "Seconds of FloodWait imposed on self profile updates.",
+          [((), ss["floodwait_seconds"])])
+    _emit_histogram(out, f"{p}_tick_lateness_seconds", "Scheduler wake-up delay after each minute boundary.",
+                    [((), lateness)])
+    _emit_histogram(out, f"{p}_handler_seconds", "Bot handler run time per route.", [
+        ((("kind", kind), ("route", key)), h.snapshot()) for (kind, key), h in list(handler_latency.items())
+    ])
+    _emit_histogram(out, f"{p}_db_query_seconds", "Database query run time per named query.", [
+        ((("query", name),), h.snapshot()) for name, h in list(db_query_stats.items())
+    ])
+    _emit_histogram(out, f"{p}_db_pool_wait_seconds", "Time spent waiting for a pooled connection.",
+                    [((), db_pool_wait.snapshot())])
+    _emit(out, f"{p}_force_join_rpc_total", "counter", "Telegram calls made for force-join checks.", [
+        ((("rpc", rpc), ("result", result)), n) for (rpc, result), n in list(force_join_rpc_stats.items())
+    ])
+    return "\n".join(out) + "\n"
+
+
 # ================== MAIN (FloodWait-handled) ==================
+async def shutdown(main_task):
+    # SIGTERM/SIGINT: write buffered flags out, then let main() wind down
+    stage = health["stage"]
+    if stage in ("stopping", "stopped"):
+        return
+    health["stage"] = "stopping"
+    print("[bot] shutting down")
+    try:
+        await flush_user_flags()
+    except Exception as e:
+        print(f"[bot] shutdown user flag flush failed: {e}")
+    if stage != "serving":
+        # still starting up: main() may be sleeping through a FloodWait with the client
+        # connected (start() connects before sign-in fails), so stop main() itself
+        main_task.cancel()
+    if bot.is_connected():
+        await bot.disconnect()   # when serving, run_until_disconnected returns and main() finishes
+
+
 async def main():
-    bot.pool = await init_db()
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, lambda: asyncio.create_task(shutdown(main_task)))
+        except (NotImplementedError, RuntimeError):
+            pass  # no signal support here (Windows / not the main thread)
+    asyncio.create_task(health_monitor())
+    health["stage"] = "database"
+    try:
+        bot.pool = await init_db()
+    except Exception as e:
+        health["fatal"] = f"init_db: {e}"
+        raise
+    await load_settings()
+    try:
+        await user_states.restore()
+    except Exception as e:
+        print(f"[bot] user_states restore error: {e}")
+    try:
+        await reconcile_user_counts()
+    except Exception as e:
+        print(f"[bot] user counts load error: {e}")
+    asyncio.create_task(state_sweeper())
+    asyncio.create_task(user_flag_flusher())
+    asyncio.create_task(user_count_reconciler())
+
+    # handlers go live at bot.start(), and activations from then on need the workers
+    if SELF_WORKERS > 0:
+        start_self_workers()
 
     # Handle FloodWait when starting the bot to avoid crashing/restarts on Render
     while True:
+        health["stage"] = "connecting"
         try:
             await bot.start(bot_token=BOT_TOKEN)
             print("[bot] started successfully")
@@ -1229,23 +3361,50 @@ async def main():
             except Exception:
                 wait = 60
             print(f"[bot] FloodWait detected — sleeping {wait} seconds")
+            health["stage"] = "flood_wait"
             await asyncio.sleep(wait + 5)
         except Exception as e:
             print(f"[bot] unexpected error on start: {e}")
             await asyncio.sleep(10)
 
+    health["stage"] = "warming"
+    asyncio.create_task(deferral_watch())
+    # force-join channels need the bot connected (admin checks / entity resolves)
+    try:
+        await load_force_join_channels()
+    except Exception as e:
+        print(f"[bot] load_force_join_channels error: {e}")
+    asyncio.create_task(cache_listener())
+    try:
+        await resume_broadcasts()
+    except Exception as e:
+        print(f"[bot] resume_broadcasts error: {e}")
+
     # load active users' tasks
     try:
         await load_all_users()
     except Exception as e:
         print(f"[bot] load_all_users error: {e}")
+        health["warmup_error"] = str(e) or type(e).__name__
 
     # keep bot running
+    health["stage"] = "serving"
     try:
         await bot.run_until_disconnected()
     except Exception as e:
         print(f"[bot] run_until_disconnected error: {e}")
+        health["fatal"] = f"run_until_disconnected: {e}"
+    finally:
+        health["stage"] = "stopped"
+        # don't lose buffered flag writes on shutdown
+        try:
+            await flush_user_flags()
+        except Exception as e:
+            print(f"[bot] final user flag flush failed: {e}")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except asyncio.CancelledError:
+        pass  # stopped by a signal before the bot finished starting
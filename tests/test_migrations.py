@@ -0,0 +1,98 @@
+"""
+Schema migrations against a real Postgres. Set TEST_DATABASE_URL to a database the tests
+may create and drop schemas in; skipped otherwise.
+"""
+import asyncio
+import importlib
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+if not TEST_DATABASE_URL:
+    pytest.skip("TEST_DATABASE_URL not set", allow_module_level=True)
+
+asyncpg = pytest.importorskip("asyncpg")
+pytest.importorskip("telethon")
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="module")
+def bot(tmp_path_factory):
+    # bot.py reads its config from env and database.txt in the working directory at import
+    # time, and the bot's session file lands there too, so import it from a scratch dir
+    workdir = tmp_path_factory.mktemp("bot")
+    (workdir / "database.txt").write_text(TEST_DATABASE_URL)
+    for key, value in (("BOT_API_ID", "1"), ("BOT_API_HASH", "x"), ("BOT_TOKEN", "x"), ("OWNER_ID", "1")):
+        os.environ.setdefault(key, value)
+    cwd = os.getcwd()
+    sys.path.insert(0, str(ROOT))
+    os.chdir(workdir)
+    try:
+        yield importlib.import_module("bot")
+    finally:
+        os.chdir(cwd)
+        sys.path.remove(str(ROOT))
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def _with_schema(test):
+    # a throwaway schema per test, so nothing touches the database's own tables
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+    admin = await asyncpg.connect(TEST_DATABASE_URL)
+    await admin.execute(f"CREATE SCHEMA {schema}")
+    pool = await asyncpg.create_pool(
+        TEST_DATABASE_URL, min_size=1, max_size=2, server_settings={"search_path": schema},
+    )
+    try:
+        return await test(pool)
+    finally:
+        await pool.close()
+        await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        await admin.close()
+
+
+def test_migrate_is_idempotent(bot, capsys):
+    async def test(pool):
+        await bot.migrate(pool)
+        first = await pool.fetch("SELECT version, applied_at FROM schema_migrations ORDER BY version")
+        assert [r["version"] for r in first] == [m[0] for m in bot.MIGRATIONS]
+        capsys.readouterr()
+
+        await bot.migrate(pool)
+        second = await pool.fetch("SELECT version, applied_at FROM schema_migrations ORDER BY version")
+        assert second == first
+        assert "applied migration" not in capsys.readouterr().out
+
+    run(_with_schema(test))
+
+
+@pytest.mark.parametrize("query, args, index", [
+    ("users_startup", (0, 500), "users_active_idx"),
+    ("broadcast_page_active", (0, 500), "users_active_idx"),
+    ("api_user_count", (7,), "users_api_id_idx"),
+])
+def test_hot_queries_use_indexes(bot, query, args, index):
+    async def test(pool):
+        await bot.migrate(pool)
+        # 50k users over 500 apps, 2% active: the shape the indexes were added for
+        await pool.execute(
+            """
+            INSERT INTO users (user_id, api_id, api_hash, session_string, base_name, font_id, is_active)
+            SELECT g, g % 500, 'hash', 'session', 'name', 1, g % 50 = 0
+            FROM generate_series(1, 50000) AS g
+            """
+        )
+        await pool.execute("ANALYZE users")
+        rows = await pool.fetch("EXPLAIN " + bot.QUERIES[query], *args)
+        plan = "\n".join(r[0] for r in rows)
+        assert index in plan, plan
+
+    run(_with_schema(test))
@@ -1,5 +1,6 @@
 import os
-from flask import Flask
+import sys
+from flask import Flask, Response, jsonify
 import threading
 import asyncio
 
@@ -9,9 +10,43 @@ app = Flask(__name__)
 def home():
     return "Bot is running"
 
+def loaded_bot():
+    # bot is imported by run_bot() on the main thread; a request must never import it itself,
+    # and may arrive while that import is still running
+    mod = sys.modules.get("bot")
+    return mod if mod is not None and hasattr(mod, "render_metrics") else None
+
+@app.route("/metrics")
+def metrics():
+    bot = loaded_bot()
+    if bot is None:
+        return Response("bot not loaded yet\n", status=503, mimetype="text/plain")
+    return Response(bot.render_metrics(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+# liveness: restart the instance when this fails. readiness: send it traffic only when this passes.
+# both only read the state bot.health_monitor keeps, so probing is free
+@app.route("/healthz")
+def healthz():
+    bot = loaded_bot()
+    if bot is None:
+        return jsonify(live=True, ready=False, problems=["bot still loading"])
+    report = bot.health_report()
+    return jsonify(report), 200 if report["live"] else 503
+
+@app.route("/readyz")
+def readyz():
+    bot = loaded_bot()
+    if bot is None:
+        return jsonify(live=True, ready=False, problems=["bot still loading"]), 503
+    report = bot.health_report()
+    return jsonify(report), 200 if report["ready"] else 503
+
 def run_bot():
     from bot import main   # 👈 فقط این خط عوض شده
-    asyncio.run(main())    # 👈 این هم
+    try:
+        asyncio.run(main())    # 👈 این هم
+    except asyncio.CancelledError:
+        pass  # stopped by SIGTERM/SIGINT before the bot finished starting
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))